@@ -0,0 +1,321 @@
+"""
+Benchmark de la API del clasificador, el sistema experto y el procesamiento de imágenes
+
+Ejecuta la aplicación FastAPI en el mismo proceso (sin servidor HTTP) con datos
+sintéticos que siguen el esquema de las plantillas de `public/` y mide
+throughput y latencias p50/p95/p99 para distintos tamaños de datos, valores de
+`steps` y niveles de concurrencia. Los resultados se guardan en JSON para
+comparar entre commits.
+
+Uso:
+    python benchmarks/benchmark_api.py --output resultados.json
+    python benchmarks/benchmark_api.py --quick --scenarios classifier_analyze,process_image
+    python benchmarks/benchmark_api.py --compare base.json nuevo.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import cv2
+import httpx
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLANTILLA_CLASIFICADOR = os.path.join(RAIZ, "public", "plantilla_sistema_clasificado.csv")
+PLANTILLA_EXPERTO = os.path.join(RAIZ, "public", "plantilla_sistema_experto.xlsx")
+
+# Las sesiones del benchmark no deben mezclarse con las del servidor real
+os.environ.setdefault("SESSION_DB", os.path.join(tempfile.mkdtemp(prefix="benchmark_"), "sesiones.db"))
+sys.path.insert(0, RAIZ)
+import main  # noqa: E402
+
+# Los logs por petición distorsionan las mediciones
+logging.getLogger().setLevel(logging.WARNING)
+
+# Configuración de los escenarios: (completa, rápida)
+ESCENARIOS = {
+    "classifier_analyze": {
+        "filas": ([768, 5000, 20000], [768]),
+        "concurrencia": ([1, 4, 16], [1, 4]),
+    },
+    "classifier_predict": {
+        "filas": ([768, 5000, 20000], [768]),
+        "concurrencia": ([1, 4, 16], [1, 4]),
+    },
+    "expert_predict": {
+        "filas": ([5, 200, 2000], [5, 200]),
+        "concurrencia": ([1, 4, 16], [1, 4]),
+    },
+    "process_image": {
+        "resoluciones": ([(320, 240), (800, 600), (1920, 1080)], [(320, 240)]),
+        "steps": ([4, 16, 32], [4, 8]),
+        "concurrencia": ([1, 2, 4], [1, 2]),
+    },
+}
+
+def generar_csv_clasificador(filas: int, semilla: int = 0) -> bytes:
+    """
+    Genera un CSV con las columnas de la plantilla del clasificador
+
+    Cada columna sigue la media y desviación de la plantilla y el resultado
+    depende de una combinación lineal de las variables para que los modelos
+    tengan algo que aprender.
+    """
+    plantilla = pd.read_csv(PLANTILLA_CLASIFICADOR)
+    rng = np.random.default_rng(semilla)
+    caracteristicas = plantilla.iloc[:, :-1]
+
+    datos = {}
+    for columna in caracteristicas.columns:
+        valores = rng.normal(caracteristicas[columna].mean(), caracteristicas[columna].std(), filas)
+        datos[columna] = np.clip(valores, caracteristicas[columna].min(), caracteristicas[columna].max()).round(3)
+    df = pd.DataFrame(datos)
+
+    normalizado = (df - df.mean()) / df.std()
+    puntuacion = normalizado.to_numpy() @ rng.normal(size=df.shape[1]) + rng.normal(scale=0.5, size=filas)
+    df[plantilla.columns[-1]] = (puntuacion > 0).astype(int)
+    return df.to_csv(index=False).encode("utf-8")
+
+def generar_excel_experto(filas: int, semilla: int = 0) -> bytes:
+    """Genera una base de conocimiento con las preguntas y decisiones de la plantilla del sistema experto"""
+    plantilla = pd.read_excel(PLANTILLA_EXPERTO)
+    rng = np.random.default_rng(semilla)
+    preguntas = plantilla.columns[:-1]
+    decisiones = plantilla.iloc[:, -1].unique()
+
+    df = pd.DataFrame(rng.integers(0, 2, size=(filas, len(preguntas))), columns=preguntas)
+    df[plantilla.columns[-1]] = rng.choice(decisiones, size=filas)
+    salida = io.BytesIO()
+    df.to_excel(salida, index=False)
+    return salida.getvalue()
+
+def generar_imagen(ancho: int, alto: int, semilla: int = 0) -> bytes:
+    """Genera una imagen PNG con gradientes suaves y ruido, parecida a una fotografía"""
+    rng = np.random.default_rng(semilla)
+    base = rng.integers(0, 256, size=(max(alto // 50, 2), max(ancho // 50, 2), 3), dtype=np.uint8)
+    img = cv2.resize(base, (ancho, alto), interpolation=cv2.INTER_CUBIC)
+    ruido = rng.normal(0, 6, size=img.shape)
+    img = np.clip(img + ruido, 0, 255).astype(np.uint8)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+def percentil(latencias: list, p: float) -> float:
+    return float(np.percentile(latencias, p)) if latencias else 0.0
+
+async def medir(nombre: str, parametros: dict, concurrencia: int, total: int, peticion) -> dict:
+    """
+    Ejecuta `total` peticiones con `concurrencia` en vuelo y resume sus latencias
+
+    Args:
+        nombre: Nombre del escenario
+        parametros: Parámetros del escenario que se guardan en el resultado
+        concurrencia: Peticiones simultáneas
+        total: Número total de peticiones
+        peticion: Corrutina sin argumentos que realiza una petición y devuelve la respuesta
+    """
+    latencias = []
+    codigos = {}
+    pendientes = iter(range(total))
+
+    async def worker():
+        for _ in pendientes:
+            inicio = time.perf_counter()
+            respuesta = await peticion()
+            latencias.append(time.perf_counter() - inicio)
+            codigos[respuesta.status_code] = codigos.get(respuesta.status_code, 0) + 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    resultado = {
+        "escenario": nombre,
+        "parametros": parametros,
+        "concurrencia": concurrencia,
+        "peticiones": total,
+        "codigos": {str(codigo): cuenta for codigo, cuenta in sorted(codigos.items())},
+        "duracion_segundos": duracion,
+        "throughput_rps": total / duracion if duracion else 0.0,
+        "latencia_p50_ms": percentil(latencias, 50) * 1000,
+        "latencia_p95_ms": percentil(latencias, 95) * 1000,
+        "latencia_p99_ms": percentil(latencias, 99) * 1000,
+        "latencia_media_ms": float(np.mean(latencias)) * 1000 if latencias else 0.0,
+    }
+    print(
+        f"{nombre:<20} {json.dumps(parametros):<40} c={concurrencia:<3} "
+        f"{resultado['throughput_rps']:8.2f} rps  p50={resultado['latencia_p50_ms']:8.1f}ms  "
+        f"p99={resultado['latencia_p99_ms']:8.1f}ms  {resultado['codigos']}"
+    )
+    return resultado
+
+async def escenario_classifier_analyze(cliente, config, args) -> list:
+    resultados = []
+    for filas in config["filas"]:
+        contenido = generar_csv_clasificador(filas)
+        respuestas = json.dumps(pd.read_csv(io.BytesIO(contenido)).iloc[0, :-1].tolist())
+        for concurrencia in config["concurrencia"]:
+            async def peticion():
+                if args.cold:
+                    main.model_cache.clear()
+                return await cliente.post(
+                    "/classifier/analyze/",
+                    files={"file": ("datos.csv", contenido)},
+                    data={"answers": respuestas},
+                )
+            resultados.append(await medir(
+                "classifier_analyze", {"filas": filas, "cold": args.cold},
+                concurrencia, args.requests, peticion
+            ))
+    return resultados
+
+async def escenario_classifier_predict(cliente, config, args) -> list:
+    resultados = []
+    for filas in config["filas"]:
+        contenido = generar_csv_clasificador(filas)
+        respuestas = pd.read_csv(io.BytesIO(contenido)).iloc[0, :-1].tolist()
+        carga = await cliente.post("/classifier/upload/", files={"file": ("datos.csv", contenido)})
+        session_id = carga.json()["session_id"]
+        # La primera predicción entrena los modelos de la sesión
+        await cliente.post(f"/classifier/predict/{session_id}", json=respuestas)
+        for concurrencia in config["concurrencia"]:
+            async def peticion():
+                return await cliente.post(f"/classifier/predict/{session_id}", json=respuestas)
+            resultados.append(await medir(
+                "classifier_predict", {"filas": filas},
+                concurrencia, args.requests, peticion
+            ))
+    return resultados
+
+async def escenario_expert_predict(cliente, config, args) -> list:
+    resultados = []
+    for filas in config["filas"]:
+        contenido = generar_excel_experto(filas)
+        n_preguntas = len(pd.read_excel(io.BytesIO(contenido)).columns) - 1
+        rng = np.random.default_rng(1)
+        for concurrencia in config["concurrencia"]:
+            async def peticion():
+                if args.cold:
+                    main.model_cache.clear()
+                respuestas = rng.integers(0, 2, size=n_preguntas).tolist()
+                return await cliente.post(
+                    "/expert-system/predict/",
+                    files={"file": ("base.xlsx", contenido)},
+                    data={"answers": json.dumps(respuestas)},
+                )
+            resultados.append(await medir(
+                "expert_predict", {"filas": filas, "cold": args.cold},
+                concurrencia, args.requests, peticion
+            ))
+    return resultados
+
+async def escenario_process_image(cliente, config, args) -> list:
+    resultados = []
+    for ancho, alto in config["resoluciones"]:
+        contenido = generar_imagen(ancho, alto)
+        for steps in config["steps"]:
+            for concurrencia in config["concurrencia"]:
+                async def peticion():
+                    if args.cold:
+                        main.image_cache.memoria.clear()
+                    return await cliente.post(
+                        f"/process-image/?steps={steps}",
+                        files={"file": ("imagen.png", contenido)},
+                    )
+                resultados.append(await medir(
+                    "process_image", {"resolucion": f"{ancho}x{alto}", "steps": steps, "cold": args.cold},
+                    concurrencia, max(args.requests // 4, concurrencia), peticion
+                ))
+    return resultados
+
+FUNCIONES_ESCENARIO = {
+    "classifier_analyze": escenario_classifier_analyze,
+    "classifier_predict": escenario_classifier_predict,
+    "expert_predict": escenario_expert_predict,
+    "process_image": escenario_process_image,
+}
+
+def commit_actual() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=RAIZ, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "desconocido"
+
+async def ejecutar(args) -> dict:
+    escenarios = args.scenarios.split(",") if args.scenarios else list(ESCENARIOS)
+    indice = 1 if args.quick else 0
+    resultados = []
+
+    transporte = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://benchmark", timeout=None) as cliente:
+        for nombre in escenarios:
+            if nombre not in ESCENARIOS:
+                raise SystemExit(f"Escenario desconocido: {nombre}")
+            config = {clave: valores[indice] for clave, valores in ESCENARIOS[nombre].items()}
+            resultados.extend(await FUNCIONES_ESCENARIO[nombre](cliente, config, args))
+    main.image_processor.shutdown()
+
+    return {
+        "commit": commit_actual(),
+        "fecha": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+        "modo": "rapido" if args.quick else "completo",
+        "resultados": resultados,
+    }
+
+def comparar(ruta_base: str, ruta_nueva: str):
+    """Muestra la variación de throughput y p99 entre dos ejecuciones"""
+    with open(ruta_base) as archivo:
+        base = json.load(archivo)
+    with open(ruta_nueva) as archivo:
+        nueva = json.load(archivo)
+
+    def clave(resultado):
+        return (resultado["escenario"], json.dumps(resultado["parametros"], sort_keys=True), resultado["concurrencia"])
+
+    indice_base = {clave(resultado): resultado for resultado in base["resultados"]}
+    print(f"Base {base['commit'][:10]} -> nuevo {nueva['commit'][:10]}")
+    for resultado in nueva["resultados"]:
+        anterior = indice_base.get(clave(resultado))
+        if anterior is None:
+            continue
+        variacion_rps = (resultado["throughput_rps"] / anterior["throughput_rps"] - 1) * 100 if anterior["throughput_rps"] else 0.0
+        variacion_p99 = (resultado["latencia_p99_ms"] / anterior["latencia_p99_ms"] - 1) * 100 if anterior["latencia_p99_ms"] else 0.0
+        print(
+            f"{resultado['escenario']:<20} {json.dumps(resultado['parametros']):<40} c={resultado['concurrencia']:<3} "
+            f"rps {variacion_rps:+7.1f}%  p99 {variacion_p99:+7.1f}%"
+        )
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark de la API")
+    parser.add_argument("--output", default="benchmark_resultados.json", help="Archivo JSON de salida")
+    parser.add_argument("--scenarios", default="", help="Escenarios separados por comas: " + ",".join(ESCENARIOS))
+    parser.add_argument("--requests", type=int, default=40, help="Peticiones por combinación de parámetros")
+    parser.add_argument("--quick", action="store_true", help="Usa menos tamaños y niveles de concurrencia")
+    parser.add_argument("--cold", action="store_true", help="Vacía las cachés de modelos e imágenes antes de cada petición")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NUEVO"), help="Compara dos archivos de resultados")
+    args = parser.parse_args()
+
+    if args.compare:
+        comparar(*args.compare)
+        return
+
+    informe = asyncio.run(ejecutar(args))
+    with open(args.output, "w") as archivo:
+        json.dump(informe, archivo, indent=2)
+    print(f"Resultados guardados en {args.output}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,12 +1,11 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Body, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Body, Form, Depends
 from fastapi.middleware.cors import CORSMiddleware
-import pandas as pd
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse, JSONResponse
 import numpy as np
-import cv2
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.preprocessing import LabelEncoder
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from multiprocessing import shared_memory
+import multiprocessing
 import base64
 from typing import List
 import io
@@ -15,13 +14,26 @@ from datetime import datetime, timedelta
 import asyncio
 import threading
 import logging
-from sklearn.naive_bayes import GaussianNB
-from sklearn.discriminant_analysis import LinearDiscriminantAnalysis, QuadraticDiscriminantAnalysis
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.svm import SVC
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import MinMaxScaler
+import importlib
+import importlib.util
 import json
+import mmap
+import zipfile
+import zlib
+import struct
+import hashlib
+import os
+import pickle
+import socket
+import sqlite3
+import stat
+import sys
+import tempfile
+import time
+from collections import OrderedDict, deque
+import re
+import types
+import weakref
 
 # Configurar logging
 logging.basicConfig(
@@ -30,8 +42,175 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Importación de las dependencias pesadas de cada subsistema
+# eager: al importar la aplicación; lazy: en el primer uso;
+# background: en un hilo en cuanto la aplicación está lista para recibir peticiones
+MODOS_IMPORTACION = ("eager", "lazy", "background")
+STARTUP_IMPORTS = os.getenv("STARTUP_IMPORTS", "eager")
+if STARTUP_IMPORTS not in MODOS_IMPORTACION:
+    raise ValueError(f"STARTUP_IMPORTS no soportado. Use uno de: {', '.join(MODOS_IMPORTACION)}")
+
+class ModuloDiferido(types.ModuleType):
+    """
+    Módulo que se importa en el primer acceso a uno de sus atributos
+    Registra cuánto tardó la importación y qué la provocó
+    """
+    def __init__(self, nombre: str, subsistema: str):
+        super().__init__(nombre)
+        self._subsistema = subsistema
+        self._modulo = None
+        self._segundos = None
+        self._origen = None
+        self._lock = threading.Lock()
+
+    def _cargar(self, origen: str = "uso"):
+        if self._modulo is None:
+            with self._lock:
+                if self._modulo is None:
+                    inicio = time.perf_counter()
+                    modulo = importlib.import_module(self.__name__)
+                    self._segundos = time.perf_counter() - inicio
+                    self._origen = origen
+                    self._modulo = modulo
+                    logger.info(f"Módulo {self.__name__} importado en {self._segundos:.3f}s ({origen})")
+        return self._modulo
+
+    def __getattr__(self, atributo: str):
+        return getattr(self._cargar(), atributo)
+
+class RegistroImportaciones:
+    """
+    Registro de los módulos diferidos y del tiempo que cuesta importar cada uno
+
+    El tiempo de un módulo es el que añadió al importarse, por lo que las
+    dependencias compartidas (por ejemplo, la base de sklearn) se cuentan en el
+    primer módulo que las necesitó.
+    """
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.listo_segundos = None
+        self._modulos = OrderedDict()
+
+    def diferir(self, nombre: str, subsistema: str) -> ModuloDiferido:
+        """Registra un módulo que se importará en su primer uso"""
+        modulo = self._modulos[nombre] = ModuloDiferido(nombre, subsistema)
+        return modulo
+
+    def precargar(self, origen: str):
+        """Importa todos los módulos registrados que aún no se cargaron"""
+        for modulo in self._modulos.values():
+            try:
+                modulo._cargar(origen)
+            except Exception as e:
+                logger.error(f"Error al importar {modulo.__name__}: {e}")
+
+    def informe(self) -> dict:
+        """Tiempo de importación por módulo y por subsistema"""
+        modulos = []
+        subsistemas = {}
+        for nombre, modulo in self._modulos.items():
+            modulos.append({
+                "modulo": nombre,
+                "subsistema": modulo._subsistema,
+                "cargado": modulo._modulo is not None,
+                "segundos": modulo._segundos,
+                "origen": modulo._origen
+            })
+            resumen = subsistemas.setdefault(modulo._subsistema, {"segundos": 0.0, "cargado": True})
+            resumen["segundos"] += modulo._segundos or 0.0
+            resumen["cargado"] = resumen["cargado"] and modulo._modulo is not None
+        return {
+            "modo": STARTUP_IMPORTS,
+            "listo_segundos": self.listo_segundos,
+            "subsistemas": subsistemas,
+            "modulos": modulos
+        }
+
+importaciones = RegistroImportaciones()
+pd = importaciones.diferir("pandas", "tablas")
+pyarrow = importaciones.diferir("pyarrow", "tablas") if importlib.util.find_spec("pyarrow") else None
+cv2 = importaciones.diferir("cv2", "imagen")
+cluster = importaciones.diferir("sklearn.cluster", "imagen")
+sklearn = importaciones.diferir("sklearn", "clasificador")
+neighbors = importaciones.diferir("sklearn.neighbors", "clasificador")
+preprocessing = importaciones.diferir("sklearn.preprocessing", "clasificador")
+naive_bayes = importaciones.diferir("sklearn.naive_bayes", "clasificador")
+discriminant_analysis = importaciones.diferir("sklearn.discriminant_analysis", "clasificador")
+tree = importaciones.diferir("sklearn.tree", "clasificador")
+svm = importaciones.diferir("sklearn.svm", "clasificador")
+linear_model = importaciones.diferir("sklearn.linear_model", "clasificador")
+model_selection = importaciones.diferir("sklearn.model_selection", "clasificador")
+joblib = importaciones.diferir("joblib", "clasificador")
+if STARTUP_IMPORTS == "eager":
+    importaciones.precargar("inicio")
+
 app = FastAPI()
 
+# Límites de tamaño de las subidas, por familia de endpoints
+LIMITES_SUBIDA = {
+    "clasificador": int(os.getenv("UPLOAD_MAX_BYTES_CLASSIFIER", str(1024 * 1024 * 1024))),
+    "experto": int(os.getenv("UPLOAD_MAX_BYTES_EXPERT", str(16 * 1024 * 1024))),
+    "imagen": int(os.getenv("UPLOAD_MAX_BYTES_IMAGE", str(100 * 1024 * 1024))),
+    "lote": int(os.getenv("IMAGE_BATCH_MAX_BYTES", str(200 * 1024 * 1024))),
+}
+RUTAS_SUBIDA = {
+    "/classifier/upload/": "clasificador",
+    "/classifier/get-parameters/": "clasificador",
+    "/classifier/analyze/": "clasificador",
+    "/classifier/analyze-batch/": "clasificador",
+    "/expert-system/upload/": "experto",
+    "/expert-system/get-questions/": "experto",
+    "/expert-system/predict/": "experto",
+    "/upload-image/": "imagen",
+    "/process-image/": "imagen",
+    "/process-images/": "lote",
+}
+# Holgura del cuerpo para los delimitadores multipart y los campos de texto del formulario
+MARGEN_FORMULARIO = 1024 * 1024
+# Los archivos mayores se mapean desde el temporal del parser en lugar de copiarse a memoria
+UPLOAD_MMAP_BYTES = int(os.getenv("UPLOAD_MMAP_BYTES", str(8 * 1024 * 1024)))
+
+class LimiteSubidas:
+    """
+    Middleware ASGI que rechaza los cuerpos que superan el límite de su endpoint
+
+    Si la petición declara Content-Length se responde 413 sin leer el cuerpo. Si
+    no lo declara se cuentan los bytes a medida que llegan y se corta la lectura
+    en cuanto se supera el límite, antes de que el parser multipart los guarde.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        tipo = RUTAS_SUBIDA.get(scope.get("path")) if scope["type"] == "http" else None
+        if tipo is None:
+            await self.app(scope, receive, send)
+            return
+
+        limite = LIMITES_SUBIDA[tipo] + MARGEN_FORMULARIO
+        detalle = f"La subida supera el límite de {LIMITES_SUBIDA[tipo]} bytes"
+        longitud = dict(scope["headers"]).get(b"content-length")
+        if longitud is not None and longitud.isdigit() and int(longitud) > limite:
+            metricas.incrementar("subidas_rechazadas_total", endpoint=tipo)
+            await JSONResponse({"detail": detalle}, status_code=413)(scope, receive, send)
+            return
+
+        recibidos = 0
+
+        async def recibir():
+            nonlocal recibidos
+            mensaje = await receive()
+            if mensaje["type"] == "http.request":
+                recibidos += len(mensaje.get("body", b""))
+                if recibidos > limite:
+                    metricas.incrementar("subidas_rechazadas_total", endpoint=tipo)
+                    raise HTTPException(status_code=413, detail=detalle)
+            return mensaje
+
+        await self.app(scope, recibir, send)
+
+app.add_middleware(LimiteSubidas)
+
 # Configurar CORS
 app.add_middleware(
     CORSMiddleware,
@@ -41,9 +220,126 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Diccionario para almacenar los datos de cada sesión
-session_data = {}
-session_lock = threading.Lock()
+# Trabajos de procesamiento de imágenes que se ejecutan en este worker, indexados por ID
+image_jobs = {}
+
+# Métricas internas en formato de exposición de Prometheus
+class Metricas:
+    """
+    Registro de contadores, histogramas de tiempos e indicadores
+    
+    Los tiempos medidos dentro de un worker de procesos se capturan con
+    `capturar()` y se devuelven junto al resultado para fusionarlos en el
+    proceso principal con `fusionar()`.
+    """
+    LIMITES = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefijo: str = "ia"):
+        self.prefijo = prefijo
+        self._contadores = {}
+        self._histogramas = {}
+        self._indicadores = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def incrementar(self, nombre: str, valor: float = 1, **etiquetas):
+        """Incrementa un contador"""
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre: str, segundos: float, **etiquetas):
+        """Registra una duración en el histograma indicado"""
+        capturadas = getattr(self._local, "capturadas", None)
+        if capturadas is not None:
+            capturadas.append((nombre, segundos, etiquetas))
+            return
+        
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = {"cubetas": [0] * len(self.LIMITES), "suma": 0.0, "cuenta": 0}
+            for i, limite in enumerate(self.LIMITES):
+                if segundos <= limite:
+                    histograma["cubetas"][i] += 1
+            histograma["suma"] += segundos
+            histograma["cuenta"] += 1
+
+    @contextmanager
+    def medir(self, nombre: str, **etiquetas):
+        """Mide la duración del bloque y la registra en el histograma indicado"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nombre, time.perf_counter() - inicio, **etiquetas)
+
+    @contextmanager
+    def capturar(self):
+        """Acumula las observaciones del bloque en una lista en lugar de registrarlas"""
+        capturadas = []
+        self._local.capturadas = capturadas
+        try:
+            yield capturadas
+        finally:
+            self._local.capturadas = None
+
+    def fusionar(self, capturadas: list):
+        """Registra observaciones capturadas en otro proceso"""
+        for nombre, segundos, etiquetas in capturadas:
+            self.observar(nombre, segundos, **etiquetas)
+
+    def registrar_indicador(self, nombre: str, ayuda: str, funcion):
+        """Registra un indicador cuyo valor se calcula al exportar"""
+        self._indicadores[nombre] = (ayuda, funcion)
+
+    @staticmethod
+    def _etiquetas(etiquetas) -> str:
+        if not etiquetas:
+            return ""
+        return "{" + ",".join(f'{clave}="{valor}"' for clave, valor in etiquetas) + "}"
+
+    def exportar(self) -> str:
+        """Genera el texto de exposición de todas las métricas"""
+        lineas = []
+        with self._lock:
+            contadores = dict(self._contadores)
+            histogramas = {clave: dict(valor, cubetas=list(valor["cubetas"])) for clave, valor in self._histogramas.items()}
+        
+        tipos_vistos = set()
+        for (nombre, etiquetas), valor in sorted(contadores.items()):
+            completo = f"{self.prefijo}_{nombre}"
+            if completo not in tipos_vistos:
+                lineas.append(f"# TYPE {completo} counter")
+                tipos_vistos.add(completo)
+            lineas.append(f"{completo}{self._etiquetas(etiquetas)} {valor}")
+        
+        for (nombre, etiquetas), histograma in sorted(histogramas.items()):
+            completo = f"{self.prefijo}_{nombre}"
+            if completo not in tipos_vistos:
+                lineas.append(f"# TYPE {completo} histogram")
+                tipos_vistos.add(completo)
+            for limite, cuenta in zip(self.LIMITES, histograma["cubetas"]):
+                lineas.append(f"{completo}_bucket{self._etiquetas(etiquetas + (('le', limite),))} {cuenta}")
+            lineas.append(f"{completo}_bucket{self._etiquetas(etiquetas + (('le', '+Inf'),))} {histograma['cuenta']}")
+            lineas.append(f"{completo}_sum{self._etiquetas(etiquetas)} {histograma['suma']}")
+            lineas.append(f"{completo}_count{self._etiquetas(etiquetas)} {histograma['cuenta']}")
+        
+        for nombre, (ayuda, funcion) in sorted(self._indicadores.items()):
+            completo = f"{self.prefijo}_{nombre}"
+            try:
+                valor = funcion()
+            except Exception as e:
+                logger.error(f"Error al calcular la métrica {nombre}: {e}")
+                continue
+            lineas.append(f"# HELP {completo} {ayuda}")
+            lineas.append(f"# TYPE {completo} gauge")
+            lineas.append(f"{completo} {valor}")
+        
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
 
 class SessionData:
     """
@@ -59,6 +355,30 @@ class SessionData:
         self.is_processing = False
         self.processed_images = []
         self.active = True
+        self.modelos = None
+        self.accuracies = None
+        self.scaler = None
+        self.tabla_decision = None
+        self.modo_entrenamiento = "auto"
+        self.modelo_id = None
+        self.archivo = None
+
+    def __setstate__(self, estado: dict):
+        """Restaura una sesión serializada completando los atributos que no tenía al guardarse"""
+        self.__init__(estado.get("data", b""), estado.get("session_type", ""))
+        self.__dict__.update(estado)
+
+    def contenido(self):
+        """
+        Contenido del archivo de la sesión
+        
+        Las subidas grandes se guardan en un archivo propio de la sesión en lugar
+        de en `data` y se mapean en solo lectura cada vez que se usan.
+        """
+        if self.archivo is None:
+            return self.data
+        with open(self.archivo, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
     def update_access(self):
         """Actualiza el timestamp de último acceso"""
@@ -68,6 +388,282 @@ class SessionData:
         """Verifica si la sesión es válida"""
         return self.active and datetime.now() - self.last_accessed < timedelta(hours=1)
 
+class AlmacenSesiones:
+    """
+    Almacén de sesiones con persistencia en SQLite y caché en memoria acotada
+    
+    Cada sesión se guarda serializada en SQLite, por lo que es visible para todos
+    los workers que compartan el archivo y sobrevive a los reinicios. En memoria
+    solo se mantienen las sesiones usadas más recientemente hasta un presupuesto
+    de bytes; las demás se leen del disco bajo demanda. La columna `version`
+    permite detectar copias en memoria desactualizadas por otro worker.
+    
+    Las subidas grandes no se serializan con la sesión: se copian a un archivo
+    con el ID de la sesión en `directorio_archivos`, que se borra con ella.
+    
+    Todas las operaciones son bloqueantes: desde las rutas se llaman con
+    `asyncio.to_thread`. El último acceso se anota en memoria con
+    `registrar_acceso` y se persiste por lotes con `volcar_accesos`.
+    """
+    def __init__(self, ruta: str, max_bytes_memoria: int, directorio_archivos: str):
+        self.ruta = ruta
+        self.max_bytes_memoria = max_bytes_memoria
+        self.directorio_archivos = directorio_archivos
+        self.bytes_en_memoria = 0
+        self._memoria = OrderedDict()
+        self._lock = threading.RLock()
+        self._accesos_pendientes = {}
+        self._lock_accesos = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sesiones (
+                id TEXT PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                activa INTEGER NOT NULL,
+                ultimo_acceso REAL NOT NULL,
+                version INTEGER NOT NULL,
+                datos BLOB NOT NULL
+            )
+            """
+        )
+        self._conexion.commit()
+
+    def _en_memoria(self, session: "SessionData", tamano: int, version: int):
+        """Guarda la sesión en la caché de memoria y descarta las menos usadas"""
+        anterior = self._memoria.pop(session.id, None)
+        if anterior is not None:
+            self.bytes_en_memoria -= anterior[1]
+        self._memoria[session.id] = (session, tamano, version)
+        self.bytes_en_memoria += tamano
+        
+        while self.bytes_en_memoria > self.max_bytes_memoria and len(self._memoria) > 1:
+            _, (_, tamano_descartado, _) = self._memoria.popitem(last=False)
+            self.bytes_en_memoria -= tamano_descartado
+
+    def _quitar_de_memoria(self, session_id: str):
+        anterior = self._memoria.pop(session_id, None)
+        if anterior is not None:
+            self.bytes_en_memoria -= anterior[1]
+
+    def guardar_archivo(self, session_id: str, contenido) -> str:
+        """
+        Copia el contenido de una subida al archivo de la sesión
+        
+        Returns:
+            str: Ruta del archivo, compartida por todos los workers
+        """
+        ruta = os.path.join(self.directorio_archivos, session_id)
+        temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+        return ruta
+
+    def _borrar_archivo(self, session_id: str):
+        try:
+            os.remove(os.path.join(self.directorio_archivos, session_id))
+        except FileNotFoundError:
+            pass
+
+    def guardar(self, session: "SessionData"):
+        """Serializa la sesión completa, incluidos los modelos entrenados, en el almacén"""
+        datos = pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL)
+        version = time.time_ns()
+        with self._lock:
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO sesiones (id, tipo, activa, ultimo_acceso, version, datos) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session.id, session.session_type, int(session.active),
+                 session.last_accessed.timestamp(), version, sqlite3.Binary(datos))
+            )
+            self._conexion.commit()
+            self._en_memoria(session, len(datos), version)
+
+    def actualizar_estado(self, session: "SessionData"):
+        """Persiste el último acceso y el estado activo sin volver a serializar la sesión"""
+        with self._lock:
+            self._conexion.execute(
+                "UPDATE sesiones SET activa = ?, ultimo_acceso = ? WHERE id = ?",
+                (int(session.active), session.last_accessed.timestamp(), session.id)
+            )
+            self._conexion.commit()
+
+    def registrar_acceso(self, session: "SessionData"):
+        """Anota el último acceso de la sesión para persistirlo en el siguiente volcado"""
+        with self._lock_accesos:
+            self._accesos_pendientes[session.id] = session.last_accessed.timestamp()
+
+    def volcar_accesos(self) -> int:
+        """
+        Persiste en una sola transacción los accesos anotados desde el último volcado
+        
+        Returns:
+            int: Número de sesiones actualizadas
+        """
+        with self._lock_accesos:
+            pendientes, self._accesos_pendientes = self._accesos_pendientes, {}
+        if not pendientes:
+            return 0
+        with self._lock:
+            self._conexion.executemany(
+                "UPDATE sesiones SET ultimo_acceso = MAX(ultimo_acceso, ?) WHERE id = ?",
+                [(ultimo_acceso, session_id) for session_id, ultimo_acceso in pendientes.items()]
+            )
+            self._conexion.commit()
+        return len(pendientes)
+
+    def get(self, session_id: str, default=None):
+        """Obtiene una sesión desde memoria o, si no está o quedó desactualizada, desde disco"""
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT activa, ultimo_acceso, version FROM sesiones WHERE id = ?",
+                (session_id,)
+            ).fetchone()
+            if fila is None:
+                self._quitar_de_memoria(session_id)
+                return default
+            
+            activa, ultimo_acceso, version = fila
+            entrada = self._memoria.get(session_id)
+            if entrada is not None and entrada[2] == version:
+                self._memoria.move_to_end(session_id)
+                session = entrada[0]
+            else:
+                datos = self._conexion.execute(
+                    "SELECT datos FROM sesiones WHERE id = ?", (session_id,)
+                ).fetchone()[0]
+                session = pickle.loads(datos)
+                self._en_memoria(session, len(datos), version)
+            
+            # El estado puede haber cambiado en otro worker
+            session.active = bool(activa)
+            session.last_accessed = max(session.last_accessed, datetime.fromtimestamp(ultimo_acceso))
+            return session
+
+    def __setitem__(self, session_id: str, session: "SessionData"):
+        self.guardar(session)
+
+    def __getitem__(self, session_id: str) -> "SessionData":
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __delitem__(self, session_id: str):
+        if self.pop(session_id, None) is None:
+            raise KeyError(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return self._conexion.execute(
+                "SELECT 1 FROM sesiones WHERE id = ?", (session_id,)
+            ).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conexion.execute("SELECT COUNT(*) FROM sesiones").fetchone()[0]
+
+    def pop(self, session_id: str, default=None):
+        """Elimina una sesión del almacén y la devuelve"""
+        with self._lock:
+            session = self.get(session_id)
+            if session is None:
+                return default
+            self._conexion.execute("DELETE FROM sesiones WHERE id = ?", (session_id,))
+            self._conexion.commit()
+            self._quitar_de_memoria(session_id)
+            self._borrar_archivo(session_id)
+            return session
+
+    def eliminar_expiradas(self, tiempo_inactivas: timedelta, tiempo_maximo: timedelta) -> List[str]:
+        """
+        Elimina las sesiones inactivas y las que superaron el tiempo máximo sin acceso
+        
+        Args:
+            tiempo_inactivas: Tiempo tras el cual se eliminan las sesiones marcadas como inactivas
+            tiempo_maximo: Tiempo sin acceso tras el cual se elimina cualquier sesión
+            
+        Returns:
+            List[str]: IDs de las sesiones eliminadas
+        """
+        # Los accesos pendientes pueden mantener vivas sesiones que parecen expiradas
+        self.volcar_accesos()
+        ahora = datetime.now()
+        limite_inactivas = (ahora - tiempo_inactivas).timestamp()
+        limite_maximo = (ahora - tiempo_maximo).timestamp()
+        condicion = "(activa = 0 AND ultimo_acceso < ?) OR ultimo_acceso < ?"
+        with self._lock:
+            eliminadas = [
+                fila[0] for fila in self._conexion.execute(
+                    f"SELECT id FROM sesiones WHERE {condicion}", (limite_inactivas, limite_maximo)
+                )
+            ]
+            self._conexion.execute(f"DELETE FROM sesiones WHERE {condicion}", (limite_inactivas, limite_maximo))
+            self._conexion.commit()
+            for session_id in eliminadas:
+                self._quitar_de_memoria(session_id)
+                self._borrar_archivo(session_id)
+        return eliminadas
+
+def directorio_privado(ruta: str) -> str:
+    """
+    Crea un directorio accesible solo por el usuario actual y comprueba que lo sea
+    
+    Los almacenes deserializan su contenido con pickle y joblib, así que un
+    directorio en el que otro usuario pueda escribir permitiría ejecutar código.
+    
+    Raises:
+        RuntimeError: Si la ruta es un enlace simbólico, pertenece a otro usuario
+            o tiene permisos para otros usuarios
+    """
+    os.makedirs(ruta, mode=0o700, exist_ok=True)
+    estado = os.lstat(ruta)
+    if not stat.S_ISDIR(estado.st_mode):
+        raise RuntimeError(f"{ruta} no es un directorio")
+    if os.name == "posix":
+        if estado.st_uid != os.getuid():
+            raise RuntimeError(f"El directorio {ruta} pertenece a otro usuario")
+        if stat.S_IMODE(estado.st_mode) & 0o077:
+            raise RuntimeError(f"El directorio {ruta} es accesible por otros usuarios, se requieren permisos 0700")
+    return ruta
+
+# Directorio privado por defecto de los datos persistidos; SESSION_DB, SESSION_FILES_DIR
+# y MODELS_DIR configurados explícitamente se usan tal cual
+DATA_DIR = os.getenv("DATA_DIR") or os.path.join(
+    tempfile.gettempdir(), f"ia-{os.getuid()}" if os.name == "posix" else "ia"
+)
+
+# Almacén de los datos de cada sesión, compartido entre workers mediante SQLite
+session_data = AlmacenSesiones(
+    ruta=os.getenv("SESSION_DB") or os.path.join(directorio_privado(DATA_DIR), "sesiones.db"),
+    max_bytes_memoria=int(os.getenv("SESSION_MEMORY_MAX_BYTES", str(256 * 1024 * 1024))),
+    directorio_archivos=os.getenv("SESSION_FILES_DIR") or directorio_privado(
+        os.path.join(directorio_privado(DATA_DIR), "subidas")
+    )
+)
+# Segundos entre volcados del último acceso de las sesiones
+SESSION_ACCESS_FLUSH_SECONDS = float(os.getenv("SESSION_ACCESS_FLUSH_SECONDS", "5"))
+
+async def crear_sesion(contents, session_type: str) -> SessionData:
+    """
+    Crea una sesión con el contenido de una subida
+    
+    Las subidas de más de UPLOAD_MMAP_BYTES se copian del temporal del parser
+    al archivo de la sesión, sin pasar por la memoria del proceso; la sesión
+    solo guarda su ruta, de modo que ni ella ni su fila de SQLite crecen con el archivo.
+    
+    Args:
+        contents: bytes o mmap devueltos por leer_subida
+        session_type: Tipo de la sesión
+    """
+    if len(contents) <= UPLOAD_MMAP_BYTES:
+        return SessionData(bytes(contents), session_type)
+    session = SessionData(b"", session_type)
+    session.archivo = await asyncio.to_thread(session_data.guardar_archivo, session.id, contents)
+    return session
+
 async def get_session(session_id: str, session_type: str = None) -> SessionData:
     """
     Obtiene y valida una sesión
@@ -82,7 +678,7 @@ async def get_session(session_id: str, session_type: str = None) -> SessionData:
     Raises:
         HTTPException: Si la sesión no existe o expiró
     """
-    session = session_data.get(session_id)
+    session = await asyncio.to_thread(session_data.get, session_id)
     
     if not session:
         raise HTTPException(
@@ -91,7 +687,7 @@ async def get_session(session_id: str, session_type: str = None) -> SessionData:
         )
 
     if not session.is_valid():
-        del session_data[session_id]
+        await asyncio.to_thread(session_data.pop, session_id, None)
         raise HTTPException(
             status_code=404,
             detail="Sesión expirada"
@@ -104,6 +700,7 @@ async def get_session(session_id: str, session_type: str = None) -> SessionData:
         )
 
     session.update_access()
+    session_data.registrar_acceso(session)
     return session
 
 @app.post("/cleanup-session/{session_id}")
@@ -118,11 +715,14 @@ async def cleanup_session(session_id: str):
         dict: Estado de la operación
     """
     try:
-        session = session_data.get(session_id)
+        session = await asyncio.to_thread(session_data.get, session_id)
         if session:
             session.active = False
-            if session.is_processing:
-                session.is_processing = False
+            # Los trabajos de otros workers se detienen al ver la sesión inactiva
+            for trabajo in list(image_jobs.values()):
+                if trabajo.session_id == session_id:
+                    trabajo.cancelar()
+            await asyncio.to_thread(session_data.actualizar_estado, session)
             logger.info(f"Sesión {session_id} marcada para limpieza")
         return {"status": "success"}
     except Exception as e:
@@ -133,267 +733,2389 @@ async def limpiar_sesiones_antiguas():
     """Limpia periódicamente las sesiones inactivas o expiradas"""
     while True:
         try:
-            tiempo_actual = datetime.now()
-            for session_id, session in list(session_data.items()):
-                if (not session.active and tiempo_actual - session.last_accessed > timedelta(minutes=5)) or \
-                   (tiempo_actual - session.last_accessed > timedelta(hours=1)):
-                    del session_data[session_id]
-                    logger.info(f"Sesión {session_id} eliminada")
+            for session_id in await asyncio.to_thread(
+                session_data.eliminar_expiradas,
+                tiempo_inactivas=timedelta(minutes=5),
+                tiempo_maximo=timedelta(hours=1)
+            ):
+                logger.info(f"Sesión {session_id} eliminada")
+            for job_id in await asyncio.to_thread(almacen_trabajos.eliminar_huerfanos):
+                trabajo = image_jobs.pop(job_id, None)
+                if trabajo:
+                    trabajo.cancelar()
+            for job_id in await asyncio.to_thread(almacen_trabajos.marcar_abandonados):
+                logger.warning(f"Trabajo {job_id} marcado como error: su worker dejó de responder")
             await asyncio.sleep(300)  # Revisar cada 5 minutos
         except Exception as e:
             logger.error(f"Error en limpieza de sesiones: {e}")
             await asyncio.sleep(60)
 
+async def volcar_accesos_sesiones():
+    """Persiste periódicamente y por lotes el último acceso de las sesiones"""
+    while True:
+        await asyncio.sleep(SESSION_ACCESS_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(session_data.volcar_accesos)
+        except Exception as e:
+            logger.error(f"Error al persistir los accesos de las sesiones: {e}")
+
+async def latir_trabajos():
+    """Renueva periódicamente el latido de los trabajos de imágenes de este worker"""
+    while True:
+        await asyncio.sleep(IMAGE_JOB_HEARTBEAT_SECONDS)
+        try:
+            await asyncio.to_thread(almacen_trabajos.latir)
+        except Exception as e:
+            logger.error(f"Error al renovar el latido de los trabajos: {e}")
+
 @app.on_event("startup")
 async def startup_event():
-    """Inicia la tarea de limpieza de sesiones al arrancar la aplicación"""
+    """Inicia las tareas de mantenimiento de sesiones y trabajos al arrancar la aplicación"""
     asyncio.create_task(limpiar_sesiones_antiguas())
+    asyncio.create_task(volcar_accesos_sesiones())
+    asyncio.create_task(latir_trabajos())
+    importaciones.listo_segundos = time.perf_counter() - importaciones.inicio
+    if STARTUP_IMPORTS == "background":
+        threading.Thread(target=importaciones.precargar, args=("precarga",), daemon=True).start()
 
-# Funciones del sistema experto
-def cargar_datos_desde_excel(archivo_excel):
+# Caché de modelos entrenados
+def estimar_tamano(valor) -> int:
     """
-    Carga y preprocesa datos desde un archivo Excel/CSV
-    
+    Estima el tamaño en bytes de un objeto a partir de su serialización
+
     Args:
-        archivo_excel: Archivo en formato bytes o path
+        valor: Objeto a medir
     Returns:
-        DataFrame procesado o None si hay error
+        int: Tamaño aproximado en bytes
     """
     try:
-        if isinstance(archivo_excel, bytes):
-            df = pd.read_csv(io.BytesIO(archivo_excel))
-        else:
-            df = pd.read_csv(archivo_excel)
-        
-        df.columns = df.columns.str.strip()
-        
-        if df.empty:
-            raise ValueError("El DataFrame está vacío.")
-        
-        return df
-    except Exception as e:
-        logger.error(f"Error al cargar el archivo: {e}")
-        return None
+        return len(pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(valor)
 
-def entrenar_modelo_knn(df):
+def clave_contenido(contents: bytes, config: dict) -> str:
     """
-    Entrena múltiples modelos de clasificación y evalúa su precisión
-    
+    Genera una clave a partir del hash del archivo y de la configuración usada
+
     Args:
-        df: DataFrame con datos de entrenamiento
+        contents: Bytes del archivo subido
+        config: Parámetros que afectan al resultado del entrenamiento
     Returns:
-        tuple: (modelos entrenados, precisión de cada modelo, scaler)
+        str: Clave hexadecimal
     """
-    try:
-        X = df.iloc[:, :-1]
-        y = df.iloc[:, -1]
-        
-        # División de datos en entrenamiento y prueba
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=751)
-        
-        # Para mejorar la escala de los datos
-        scaler = MinMaxScaler()
-        X_train = scaler.fit_transform(X_train)
-        X_test = scaler.transform(X_test)
-        
-        modelos = {
-            'knn': KNeighborsClassifier(n_neighbors=3),
-            'bayes': GaussianNB(),
-            'lda': LinearDiscriminantAnalysis(),
-            'qda': QuadraticDiscriminantAnalysis(),
-            'tree': DecisionTreeClassifier(),
-            'svm': SVC()
-        }
-        
-        accuracies = {}
-        for nombre, modelo in modelos.items():
-            modelo.fit(X_train, y_train)
-            accuracies[nombre] = float(modelo.score(X_test, y_test))
-        
-        return modelos, accuracies, scaler
-    except Exception as e:
-        logger.error(f"Error al entrenar los modelos: {e}")
-        return None, None, None
+    hasher = hashlib.sha256(contents)
+    hasher.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    return hasher.hexdigest()
 
-# Funciones de procesamiento de imágenes
-def process_single_kmeans(args):
+class CacheLRU:
     """
-    Procesa una imagen con K-means para un valor específico de k
-    
-    Args:
-        args: tupla (dataset, k, shape)
-        
-    Returns:
-        str: imagen procesada en formato base64
+    Caché LRU acotada por número de entradas y por tamaño total en bytes
+    Las entradas menos usadas se descartan primero al superar cualquiera de los límites
     """
-    dataset, k, shape = args
-    logger.info(f"Iniciando clustering con k={k}")
-    
-    try:
-        modelo_cluster = MiniBatchKMeans(
-            n_clusters=k,
-            batch_size=1024,
-            random_state=42,
-            max_iter=300
-        )
-        
-        etiquetas = modelo_cluster.fit_predict(dataset)
-        centroides = modelo_cluster.cluster_centers_
-        centroides = np.clip(centroides * 255, 0, 255)
-        resultado = centroides[etiquetas].reshape(shape)
-        img_resultado = np.clip(resultado, 0, 255).astype(np.uint8)
-        img_resultado = cv2.cvtColor(img_resultado, cv2.COLOR_RGB2BGR)
-        
-        _, buffer = cv2.imencode('.jpg', img_resultado, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
-        
-        return f"data:image/jpeg;base64,{img_base64}"
-    except Exception as e:
-        logger.error(f"Error en clustering k={k}: {str(e)}")
-        raise
+    def __init__(self, max_entradas: int, max_bytes: int):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.bytes_usados = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+    def get(self, clave):
+        """Devuelve el valor asociado a la clave o None si no está en caché"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return entrada[0]
+
+    def put(self, clave, valor, tamano: int = None):
+        """Guarda un valor y descarta las entradas más antiguas si es necesario"""
+        if tamano is None:
+            tamano = estimar_tamano(valor)
+        if tamano > self.max_bytes:
+            logger.info(f"Entrada de {tamano} bytes excede el límite de la caché, no se guarda")
+            return
 
-def process_image_with_kmeans(image_array: np.ndarray, n_clusters: int) -> List[str]:
+        with self._lock:
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self.bytes_usados -= anterior[1]
+            self._entradas[clave] = (valor, tamano)
+            self.bytes_usados += tamano
+
+            while len(self._entradas) > self.max_entradas or self.bytes_usados > self.max_bytes:
+                _, (_, tamano_descartado) = self._entradas.popitem(last=False)
+                self.bytes_usados -= tamano_descartado
+
+    def clear(self):
+        """Vacía la caché"""
+        with self._lock:
+            self._entradas.clear()
+            self.bytes_usados = 0
+
+class CacheDisco:
     """
-    Procesa una imagen aplicando K-means con diferentes valores de k
+    Caché en disco con un archivo pickle por entrada, acotada por tamaño total
     
-    Args:
-        image_array: Array NumPy con la imagen
-        n_clusters: Número máximo de clusters a usar
-        
-    Returns:
-        List[str]: Lista de imágenes procesadas en formato base64
+    Las entradas se escriben con un renombrado atómico para que varios procesos
+    puedan compartir el directorio. Al leer se actualiza la fecha de modificación
+    y al superar el límite se borran primero las entradas menos recientes.
     """
-    logger.info(f"Iniciando procesamiento de imagen con {n_clusters} clusters")
-    
-    try:
-        image_rgb = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
-        
-        # Redimensionar si la imagen es muy grande
-        max_dimension = 800
-        height, width = image_rgb.shape[:2]
-        if max(height, width) > max_dimension:
-            scale = max_dimension / max(height, width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            image_rgb = cv2.resize(image_rgb, (new_width, new_height))
-        
-        height, width, channels = image_rgb.shape
-        dataset = image_rgb.astype(np.float32) / 255.0
-        dataset = dataset.reshape(-1, channels)
-        
-        args_list = [(dataset, k, image_rgb.shape) for k in range(2, n_clusters + 1)]
-        num_workers = min(n_clusters-1, 4)
-        
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            processed_images = list(executor.map(process_single_kmeans, args_list))
-        
-        return processed_images
-    except Exception as e:
-        logger.error(f"Error en procesamiento: {str(e)}")
-        raise
+    def __init__(self, ruta: str, max_bytes: int):
+        os.makedirs(ruta, exist_ok=True)
+        self.ruta = ruta
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.bytes_usados = sum(entrada.stat().st_size for entrada in self._entradas())
 
-# Rutas del sistema clasificador
-@app.post("/classifier/upload/")
-async def upload_classifier_file(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        session = SessionData(contents, 'classifier')
-        
-        df = cargar_datos_desde_excel(contents)
-        if df is None:
-            raise HTTPException(status_code=400, detail="Error al cargar el archivo")
-            
-        preguntas = df.columns[:-1].tolist()
-        
-        with session_lock:
-            session_data[session.id] = session
-        
-        return {
-            "message": "Archivo cargado correctamente",
-            "session_id": session.id,
-            "questions": preguntas
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    def _entradas(self):
+        return [entrada for entrada in os.scandir(self.ruta) if entrada.name.endswith(".pkl")]
 
-@app.post("/classifier/predict/{session_id}")
-async def predict_classifier(session_id: str, respuestas: List[float]):
+    def _archivo(self, clave: str) -> str:
+        return os.path.join(self.ruta, f"{clave}.pkl")
+
+    def get(self, clave: str):
+        """Devuelve el valor asociado a la clave o None si no está en disco"""
+        archivo = self._archivo(clave)
+        try:
+            with open(archivo, "rb") as f:
+                valor = pickle.load(f)
+            os.utime(archivo)
+            return valor
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Entrada de caché ilegible en {archivo}: {e}")
+            return None
+
+    def put(self, clave: str, valor):
+        """Guarda un valor y recorta el directorio si supera el límite"""
+        datos = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(datos) > self.max_bytes:
+            return
+        archivo = self._archivo(clave)
+        temporal = f"{archivo}.{uuid.uuid4().hex}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(datos)
+        with self._lock:
+            try:
+                self.bytes_usados -= os.path.getsize(archivo)
+            except OSError:
+                pass
+            os.replace(temporal, archivo)
+            self.bytes_usados += len(datos)
+            if self.bytes_usados > self.max_bytes:
+                self._recortar()
+
+    def _recortar(self):
+        """Borra las entradas menos recientes hasta quedar en el 90% del límite"""
+        entradas = sorted(self._entradas(), key=lambda entrada: entrada.stat().st_mtime)
+        self.bytes_usados = sum(entrada.stat().st_size for entrada in entradas)
+        for entrada in entradas:
+            if self.bytes_usados <= self.max_bytes * 0.9:
+                break
+            try:
+                tamano = entrada.stat().st_size
+                os.remove(entrada.path)
+                self.bytes_usados -= tamano
+            except OSError:
+                pass
+
+class CacheNiveles:
     """
-    Endpoint para realizar predicciones usando los modelos entrenados
+    Caché de dos niveles: memoria LRU y, opcionalmente, disco
+    Los aciertos en disco se promueven a memoria
+    
+    Desde el bucle de eventos se usan `aget` y `aput`, que llevan la lectura,
+    la serialización y la escritura en disco a un executor.
     """
-    try:
-        with session_lock:
-            session = session_data.get(session_id)
-            if not session or session.session_type != 'classifier':
-                raise HTTPException(status_code=404, detail="Sesión no encontrada")
-        
-        df = cargar_datos_desde_excel(session.data)
-        if df is None:
-            raise HTTPException(status_code=400, detail="Error al cargar los datos")
-        
-        if not hasattr(session, 'modelos') or session.modelos is None:
-            modelos, accuracies, scaler = entrenar_modelo_knn(df)
-            if modelos is None:
-                raise HTTPException(status_code=500, detail="Error al entrenar los modelos")
-            session.modelos = modelos
-            session.accuracies = accuracies
-            session.scaler = scaler
-        
-        respuestas_norm = session.scaler.transform([respuestas])
-        
-        predicciones = {}
-        for nombre, modelo in session.modelos.items():
-            pred_valor = int(modelo.predict(respuestas_norm)[0])
-            predicciones[nombre] = {
-                "mensaje": "Posible caso de diabetes" if pred_valor == 1 else "No se detecta diabetes",
-                "valor": pred_valor,
-                "accuracy": session.accuracies[nombre]
-            }
-        
-        votos_positivos = sum(1 for pred in predicciones.values() if pred["valor"] == 1)
-        prediccion_final = "Posible caso de diabetes" if votos_positivos > len(predicciones)/2 else "No se detecta diabetes"
-        
-        return {
-            "decision": prediccion_final,
-            "predicciones_por_modelo": predicciones
-        }
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    def __init__(self, memoria: CacheLRU, disco: CacheDisco = None):
+        self.memoria = memoria
+        self.disco = disco
 
-# Rutas del sistema experto
-@app.post("/expert-system/upload/")
-async def upload_expert_file(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        session = SessionData(contents, 'expert')
-        
-        # Aquí asumimos que el archivo es Excel y tiene el formato correcto para el sistema experto
-        df = pd.read_excel(io.BytesIO(contents))
-        if df.empty:
-            raise HTTPException(status_code=400, detail="El archivo está vacío")
-            
-        preguntas = df.columns[:-1].tolist()
-        
-        with session_lock:
-            session_data[session.id] = session
-        
-        return {
-            "message": "Base de conocimiento cargada correctamente",
-            "session_id": session.id,
-            "questions": preguntas
-        }
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+    def _get_memoria(self, clave: str):
+        valor = self.memoria.get(clave)
+        if valor is not None:
+            metricas.incrementar("cache_imagenes_consultas_total", nivel="memoria")
+        return valor
 
-@app.post("/expert-system/get-questions/")
-async def get_questions(file: UploadFile = File(...)):
-    """Endpoint para obtener las preguntas del archivo"""
-    try:
-        contents = await file.read()
-        df = pd.read_excel(io.BytesIO(contents))
-        
+    def _get_disco(self, clave: str):
+        if self.disco is not None:
+            valor = self.disco.get(clave)
+            if valor is not None:
+                metricas.incrementar("cache_imagenes_consultas_total", nivel="disco")
+                self.memoria.put(clave, valor)
+                return valor
+        metricas.incrementar("cache_imagenes_consultas_total", nivel="fallo")
+        return None
+
+    def _put_disco(self, clave: str, valor):
+        try:
+            self.disco.put(clave, valor)
+        except OSError as e:
+            logger.warning(f"No se pudo escribir en la caché de disco: {e}")
+
+    def get(self, clave: str):
+        """Busca la clave en memoria y después en disco"""
+        valor = self._get_memoria(clave)
+        return valor if valor is not None else self._get_disco(clave)
+
+    def put(self, clave: str, valor, tamano: int = None):
+        """Guarda el valor en todos los niveles"""
+        self.memoria.put(clave, valor, tamano)
+        if self.disco is not None:
+            self._put_disco(clave, valor)
+
+    async def aget(self, clave: str):
+        """Como get, consultando el disco en un executor"""
+        valor = self._get_memoria(clave)
+        if valor is not None or self.disco is None:
+            return valor if valor is not None else self._get_disco(clave)
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_disco, clave)
+
+    async def aput(self, clave: str, valor, tamano: int):
+        """Como put, escribiendo en disco en un executor; `tamano` evita serializar el valor para medirlo"""
+        self.memoria.put(clave, valor, tamano)
+        if self.disco is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._put_disco, clave, valor)
+
+# Presupuestos del entrenamiento del ensamble
+TRAINING_MAX_WORKERS = int(os.getenv("TRAINING_MAX_WORKERS", "6"))
+TRAINING_MODEL_TIMEOUT = float(os.getenv("TRAINING_MODEL_TIMEOUT", "30"))
+SVM_MAX_FILAS = int(os.getenv("SVM_MAX_FILAS", "10000"))
+
+# Índice de vecinos para los KNN del clasificador y del sistema experto
+BACKENDS_VECINOS = ("auto", "exact", "brute", "ivf")
+KNN_BACKEND = os.getenv("KNN_BACKEND", "auto")
+# En modo auto se usa el índice aproximado a partir de este número de filas
+KNN_IVF_MIN_FILAS = int(os.getenv("KNN_IVF_MIN_ROWS", "200000"))
+# Listas que se revisan por consulta: más listas, mayor exhaustividad y latencia
+KNN_IVF_NPROBE = int(os.getenv("KNN_IVF_NPROBE", "8"))
+
+# Entrenamiento por bloques para archivos que no caben en memoria
+MODOS_ENTRENAMIENTO = ("auto", "memory", "streaming")
+TRAINING_STREAMING_BYTES = int(os.getenv("TRAINING_STREAMING_BYTES", str(100 * 1024 * 1024)))
+TRAINING_CHUNK_ROWS = int(os.getenv("TRAINING_CHUNK_ROWS", "50000"))
+TRAINING_RESERVOIR_ROWS = int(os.getenv("TRAINING_RESERVOIR_ROWS", "50000"))
+
+# Configuración que determina el resultado del entrenamiento; forma parte de la clave de caché
+CONFIG_CLASIFICADOR = {
+    "modelo": "ensamble",
+    "test_size": 0.1,
+    "random_state": 751,
+    "svm_max_filas": SVM_MAX_FILAS,
+    "knn_backend": KNN_BACKEND,
+    "knn_nprobe": KNN_IVF_NPROBE,
+    "version": 4
+}
+CONFIG_EXPERTO = {
+    "modelo": "tabla_knn",
+    "n_neighbors": 3,
+    "knn_backend": KNN_BACKEND,
+    "knn_nprobe": KNN_IVF_NPROBE,
+    "version": 3
+}
+
+# Con respuestas binarias se precalculan todas las combinaciones hasta este número
+EXPERTO_MAX_COMBINACIONES = int(os.getenv("EXPERT_MAX_COMBINATIONS", "65536"))
+# Límite de entradas de la tabla, incluidas las consultas memorizadas
+EXPERTO_MAX_REGLAS = int(os.getenv("EXPERT_MAX_RULES", "200000"))
+
+# Caché global de modelos entrenados indexada por contenido del archivo
+model_cache = CacheLRU(
+    max_entradas=int(os.getenv("MODEL_CACHE_MAX_ENTRIES", "32")),
+    max_bytes=int(os.getenv("MODEL_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+)
+
+# Ensambles con modelos descartados por tiempo: se reutilizan durante
+# TRAINING_DEGRADED_TTL segundos para no reentrenar en cada petición, pero no
+# entran en model_cache ni se guardan en sesiones o modelos exportados
+TRAINING_DEGRADED_TTL = float(os.getenv("TRAINING_DEGRADED_TTL", "300"))
+ensambles_degradados = CacheLRU(max_entradas=8, max_bytes=model_cache.max_bytes)
+
+# Ingesta de archivos subidos
+class LectorBuffer(io.RawIOBase):
+    """
+    Archivo de solo lectura sobre un buffer (bytes o mmap) que no copia su contenido
+
+    A diferencia de io.BytesIO sobre un mmap, cada lectura copia solo el bloque
+    pedido, por lo que pandas y openpyxl pueden leer directamente del archivo mapeado.
+    """
+    def __init__(self, buffer):
+        self._vista = memoryview(buffer).cast("B")
+        self._posicion = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, destino) -> int:
+        n = max(0, min(len(destino), len(self._vista) - self._posicion))
+        destino[:n] = self._vista[self._posicion:self._posicion + n]
+        self._posicion += n
+        return n
+
+    def seek(self, desplazamiento: int, origen: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._posicion, io.SEEK_END: len(self._vista)}[origen]
+        self._posicion = max(0, base + desplazamiento)
+        return self._posicion
+
+    def tell(self) -> int:
+        return self._posicion
+
+    def close(self):
+        self._vista.release()
+        super().close()
+
+def abrir_buffer(buffer) -> io.BufferedReader:
+    """Abre un buffer como archivo binario para los lectores de pandas y zipfile"""
+    return io.BufferedReader(LectorBuffer(buffer), buffer_size=1024 * 1024)
+
+async def leer_subida(archivo: UploadFile, tipo: str):
+    """
+    Lee un archivo subido respetando el límite de su familia de endpoints
+
+    El parser multipart ya deja en un archivo temporal las subidas de más de
+    1MB. Las que superan UPLOAD_MMAP_BYTES se mapean en solo lectura desde ese
+    archivo en lugar de copiarse, de modo que sus páginas las gestiona la caché
+    del sistema y la memoria de cada petición queda acotada.
+
+    Args:
+        archivo: Archivo recibido en el formulario
+        tipo: Clave de LIMITES_SUBIDA del endpoint
+    Returns:
+        bytes o mmap con el contenido del archivo
+    Raises:
+        HTTPException: 413 si el archivo supera el límite
+    """
+    limite = LIMITES_SUBIDA[tipo]
+    tamano = archivo.size
+    if tamano is not None and tamano > limite:
+        metricas.incrementar("subidas_rechazadas_total", endpoint=tipo)
+        raise HTTPException(status_code=413, detail=f"El archivo supera el límite de {limite} bytes")
+
+    if tamano is not None and tamano > UPLOAD_MMAP_BYTES:
+        await archivo.seek(0)
+        metricas.incrementar("subidas_mapeadas_total", endpoint=tipo)
+        return mmap.mmap(archivo.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    bloques = bytearray()
+    while bloque := await archivo.read(1024 * 1024):
+        bloques += bloque
+        if len(bloques) > limite:
+            metricas.incrementar("subidas_rechazadas_total", endpoint=tipo)
+            raise HTTPException(status_code=413, detail=f"El archivo supera el límite de {limite} bytes")
+    return bytes(bloques)
+
+# Firmas de los formatos columnares aceptados además de CSV
+FIRMAS_TABLA = {b"PAR1": "parquet", b"ARROW1": "feather"}
+
+# El motor de pyarrow lee CSV en varios hilos cuando está instalado
+MOTOR_CSV = "pyarrow" if pyarrow is not None else "c"
+
+def detectar_formato_tabla(cabecera: bytes) -> str:
+    """
+    Identifica el formato de un archivo tabular por sus primeros bytes
+
+    Args:
+        cabecera: Primeros bytes del archivo
+    Returns:
+        str: 'parquet', 'feather' o 'csv'
+    """
+    for firma, formato in FIRMAS_TABLA.items():
+        if cabecera[:len(firma)] == firma:
+            return formato
+    return "csv"
+
+def requerir_pyarrow(formato: str):
+    """
+    Verifica que pyarrow esté disponible para leer un formato columnar
+
+    Raises:
+        HTTPException: Si pyarrow no está instalado
+    """
+    if pyarrow is None:
+        raise HTTPException(status_code=400, detail=f"Se requiere pyarrow para leer archivos {formato}")
+
+def leer_encabezado(contents: bytes) -> List[str]:
+    """
+    Lee los nombres de columna de un archivo tabular sin procesar sus filas
+
+    Args:
+        contents: Bytes del archivo CSV, Parquet o Feather
+    Returns:
+        List[str]: Nombres de columna sin espacios alrededor
+    Raises:
+        HTTPException: Si el archivo no tiene columnas suficientes
+    """
+    formato = detectar_formato_tabla(contents)
+    if formato == "csv":
+        columnas = pd.read_csv(abrir_buffer(contents), nrows=0).columns
+    else:
+        requerir_pyarrow(formato)
+        if formato == "parquet":
+            import pyarrow.parquet
+            columnas = pyarrow.parquet.read_schema(pyarrow.BufferReader(contents)).names
+        else:
+            import pyarrow.ipc
+            columnas = pyarrow.ipc.open_file(pyarrow.BufferReader(contents)).schema.names
+
+    columnas = [str(columna).strip() for columna in columnas]
+    if len(columnas) < 2:
+        raise HTTPException(status_code=400, detail="El archivo no tiene columnas suficientes")
+    return columnas
+
+def leer_csv_compacto(origen) -> "pd.DataFrame":
+    """
+    Lee un CSV declarando float32 para los parámetros
+
+    Declarar los tipos evita la inferencia por columna y reduce a la mitad la
+    memoria de los parámetros. Si alguno no es numérico se recurre a la
+    inferencia de pandas.
+
+    Args:
+        origen: Ruta o buffer con el CSV
+    Returns:
+        DataFrame con los parámetros en float32 y la columna de resultado inferida
+    """
+    columnas = pd.read_csv(origen, nrows=0).columns
+    if hasattr(origen, "seek"):
+        origen.seek(0)
+
+    tipos = {columna: np.float32 for columna in columnas[:-1]}
+    try:
+        return pd.read_csv(origen, dtype=tipos, engine=MOTOR_CSV)
+    except ValueError as e:
+        logger.warning(f"Parámetros no numéricos, se infieren los tipos: {e}")
+        if hasattr(origen, "seek"):
+            origen.seek(0)
+        return pd.read_csv(origen)
+
+def cargar_datos_desde_excel(archivo_excel):
+    """
+    Carga y preprocesa datos desde un archivo CSV, Parquet o Feather
+    
+    Args:
+        archivo_excel: Ruta o buffer (bytes o mmap) con el archivo
+    Returns:
+        DataFrame procesado o None si hay error
+    """
+    try:
+        with metricas.medir("clasificador_carga_segundos"):
+            if not isinstance(archivo_excel, (str, os.PathLike)):
+                formato = detectar_formato_tabla(archivo_excel)
+                origen = abrir_buffer(archivo_excel)
+            else:
+                with open(archivo_excel, "rb") as archivo:
+                    formato = detectar_formato_tabla(archivo.read(8))
+                origen = archivo_excel
+
+            if formato == "csv":
+                df = leer_csv_compacto(origen)
+            else:
+                requerir_pyarrow(formato)
+                df = pd.read_parquet(origen) if formato == "parquet" else pd.read_feather(origen)
+                df = df.astype({
+                    columna: np.float32 for columna in df.columns[:-1]
+                    if pd.api.types.is_numeric_dtype(df[columna])
+                })
+        
+        df.columns = df.columns.str.strip()
+        
+        if df.empty:
+            raise ValueError("El DataFrame está vacío.")
+        
+        return df
+    except Exception as e:
+        logger.error(f"Error al cargar el archivo: {e}")
+        return None
+
+class ClasificadorVecinos:
+    """
+    Clasificador KNN con búsqueda de vecinos intercambiable
+
+    Expone fit, predict, predict_proba y score como KNeighborsClassifier.
+    Backends:
+        exact: KNeighborsClassifier de sklearn
+        brute: fuerza bruta vectorizada sobre float32
+        ivf: índice invertido; los puntos se agrupan con k-means en
+             ~sqrt(n) listas y cada consulta solo revisa las `nprobe` listas
+             de centroides más cercanos. `nprobe` se puede ajustar tras el
+             entrenamiento para equilibrar exhaustividad y latencia.
+    En modo auto se usa exact por debajo de KNN_IVF_MIN_ROWS filas e ivf por encima.
+    """
+    def __init__(self, n_neighbors: int = 3, backend: str = None, nprobe: int = None):
+        backend = backend or KNN_BACKEND
+        if backend not in BACKENDS_VECINOS:
+            raise ValueError(f"Backend de vecinos no soportado. Use uno de: {', '.join(BACKENDS_VECINOS)}")
+        self.n_neighbors = n_neighbors
+        self.backend = backend
+        self.nprobe = nprobe or KNN_IVF_NPROBE
+
+    def fit(self, X, y):
+        """Construye el índice una sola vez sobre los datos de entrenamiento"""
+        X = np.asarray(X)
+        self.n_features_in_ = X.shape[1]
+        self.classes_, codigos = np.unique(np.asarray(y), return_inverse=True)
+        if self.backend == "auto":
+            self.backend = "ivf" if len(X) >= KNN_IVF_MIN_FILAS else "exact"
+
+        if self.backend == "exact":
+            self._sklearn = neighbors.KNeighborsClassifier(n_neighbors=self.n_neighbors).fit(X, y)
+            return self
+
+        puntos = np.ascontiguousarray(X, dtype=np.float32)
+        if self.backend == "ivf":
+            n_listas = max(int(np.sqrt(len(puntos))), 1)
+            rng = np.random.default_rng(CONFIG_CLASIFICADOR["random_state"])
+            muestra = puntos[rng.choice(len(puntos), size=min(len(puntos), 50 * n_listas), replace=False)]
+            with metricas.medir("vecinos_indice_segundos"):
+                kmeans = cluster.MiniBatchKMeans(
+                    n_clusters=n_listas, n_init=1, batch_size=4096,
+                    random_state=CONFIG_CLASIFICADOR["random_state"]
+                ).fit(muestra)
+                self.centroides_ = kmeans.cluster_centers_.astype(np.float32)
+                listas, _ = asignar_centroides(puntos, self.centroides_)
+        else:
+            self.centroides_ = puntos.mean(axis=0, keepdims=True)
+            listas = np.zeros(len(puntos), dtype=np.int32)
+
+        # Puntos ordenados por lista: cada lista es un rango contiguo
+        orden = np.argsort(listas, kind="stable")
+        self.puntos_ = puntos[orden]
+        self.normas_ = (self.puntos_ ** 2).sum(axis=1)
+        self.codigos_ = codigos[orden]
+        self.limites_ = np.searchsorted(listas[orden], np.arange(len(self.centroides_) + 1))
+        return self
+
+    def _vecinos(self, consultas: np.ndarray) -> np.ndarray:
+        """
+        Busca los n_neighbors vecinos de cada consulta en las listas revisadas
+
+        Returns:
+            np.ndarray: Índices (n_consultas, n_neighbors) en puntos_; -1 si faltan vecinos
+        """
+        consultas = np.ascontiguousarray(consultas, dtype=np.float32)
+        n, k = len(consultas), self.n_neighbors
+        nprobe = min(self.nprobe, len(self.centroides_))
+        mejores_d = np.full((n, k), np.inf, dtype=np.float32)
+        mejores_i = np.full((n, k), -1, dtype=np.int64)
+
+        if len(self.centroides_) == 1:
+            sondeadas = np.zeros((n, 1), dtype=np.int64)
+        else:
+            d = (self.centroides_ ** 2).sum(axis=1) - 2.0 * (consultas @ self.centroides_.T)
+            sondeadas = np.argpartition(d, nprobe - 1, axis=1)[:, :nprobe]
+
+        # Se recorre cada lista una vez con todas las consultas que la revisan
+        for lista in np.unique(sondeadas):
+            filas = np.flatnonzero((sondeadas == lista).any(axis=1))
+            inicio, fin = self.limites_[lista], self.limites_[lista + 1]
+            if inicio == fin:
+                continue
+            d = self.normas_[inicio:fin] - 2.0 * (consultas[filas] @ self.puntos_[inicio:fin].T)
+            if d.shape[1] > k:
+                cercanos = np.argpartition(d, k - 1, axis=1)[:, :k]
+                d = np.take_along_axis(d, cercanos, axis=1)
+            else:
+                cercanos = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+            candidatos_d = np.concatenate([mejores_d[filas], d], axis=1)
+            candidatos_i = np.concatenate([mejores_i[filas], cercanos + inicio], axis=1)
+            elegidos = np.argsort(candidatos_d, axis=1, kind="stable")[:, :k]
+            mejores_d[filas] = np.take_along_axis(candidatos_d, elegidos, axis=1)
+            mejores_i[filas] = np.take_along_axis(candidatos_i, elegidos, axis=1)
+
+        return mejores_i
+
+    def predict_proba(self, X) -> np.ndarray:
+        """Proporción de vecinos de cada clase, en el orden de classes_"""
+        if self.backend == "exact":
+            return self._sklearn.predict_proba(X)
+
+        X = np.asarray(X)
+        n_clases = len(self.classes_)
+        probabilidades = np.empty((len(X), n_clases))
+        # Bloques de consultas para acotar la matriz de distancias a ~16M elementos
+        candidatos = min(self.nprobe, len(self.centroides_)) * int(np.diff(self.limites_).max())
+        tamano_bloque = max(1, (1 << 24) // max(candidatos, 1))
+        for inicio in range(0, len(X), tamano_bloque):
+            vecinos = self._vecinos(X[inicio:inicio + tamano_bloque])
+            validos = vecinos >= 0
+            n = len(vecinos)
+            celdas = np.arange(n)[:, None] * n_clases + self.codigos_[np.maximum(vecinos, 0)]
+            conteos = np.bincount(celdas[validos], minlength=n * n_clases).reshape(n, n_clases)
+            probabilidades[inicio:inicio + n] = conteos / np.maximum(validos.sum(axis=1, keepdims=True), 1)
+        return probabilidades
+
+    def predict(self, X) -> np.ndarray:
+        """Clase mayoritaria entre los vecinos de cada fila"""
+        if self.backend == "exact":
+            return self._sklearn.predict(X)
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+    def score(self, X, y) -> float:
+        """Precisión sobre un conjunto etiquetado"""
+        return float((self.predict(X) == np.asarray(y)).mean())
+
+# Pool compartido para entrenar los modelos del ensamble en paralelo
+training_executor = ThreadPoolExecutor(max_workers=TRAINING_MAX_WORKERS)
+
+# Modelos descartados por tiempo cuyo hilo sigue entrenando; ocupan un worker del pool hasta terminar
+entrenamientos_abandonados = 0
+entrenamientos_abandonados_lock = threading.Lock()
+
+def abandonar_entrenamiento(futuro):
+    """Cuenta el hilo de un modelo descartado hasta que su entrenamiento termine"""
+    global entrenamientos_abandonados
+
+    def liberar(_):
+        global entrenamientos_abandonados
+        with entrenamientos_abandonados_lock:
+            entrenamientos_abandonados -= 1
+
+    with entrenamientos_abandonados_lock:
+        entrenamientos_abandonados += 1
+    futuro.add_done_callback(liberar)
+
+def entrenar_un_modelo(nombre: str, modelo, X_train, y_train, X_test, y_test) -> float:
+    """
+    Entrena y evalúa un modelo del ensamble
+    
+    El SVC escala de forma aproximadamente cuadrática con las filas, por lo que
+    por encima de SVM_MAX_FILAS se entrena con una submuestra aleatoria.
+    
+    Returns:
+        float: Precisión sobre el conjunto de prueba
+    """
+    if nombre == 'svm' and len(X_train) > SVM_MAX_FILAS:
+        logger.info(f"SVC entrenado con una submuestra de {SVM_MAX_FILAS} de {len(X_train)} filas")
+        indices = np.random.default_rng(CONFIG_CLASIFICADOR["random_state"]).choice(
+            len(X_train), size=SVM_MAX_FILAS, replace=False
+        )
+        X_train, y_train = X_train[indices], np.asarray(y_train)[indices]
+    
+    with metricas.medir("clasificador_entrenamiento_segundos", modelo=nombre):
+        modelo.fit(X_train, y_train)
+    with metricas.medir("clasificador_evaluacion_segundos", modelo=nombre):
+        return float(modelo.score(X_test, y_test))
+
+def verificar_capacidad_entrenamiento():
+    """
+    Rechaza un entrenamiento si todos los workers del pool siguen ocupados por modelos descartados
+
+    Raises:
+        HTTPException: 503 mientras no se libere ningún worker
+    """
+    if entrenamientos_abandonados >= TRAINING_MAX_WORKERS:
+        raise HTTPException(
+            status_code=503,
+            detail="Los workers de entrenamiento están ocupados por modelos descartados, inténtelo más tarde"
+        )
+
+def entrenar_en_paralelo(modelos: dict, X_train, y_train, X_test, y_test) -> tuple:
+    """
+    Entrena y evalúa en paralelo los modelos indicados
+
+    Un modelo que no termina dentro de TRAINING_MODEL_TIMEOUT segundos desde que
+    empieza a entrenarse se descarta: queda en el diccionario con valor None y no
+    participa en la votación. El tiempo en la cola del pool no cuenta, así que los
+    modelos de otras peticiones no agotan el presupuesto de estos.
+
+    Args:
+        modelos: Diccionario nombre -> modelo sin entrenar
+        X_train, y_train: Datos de entrenamiento ya escalados
+        X_test, y_test: Datos de prueba ya escalados
+    Returns:
+        tuple: (modelos entrenados, precisión de cada modelo)
+    Raises:
+        HTTPException: Si todos los workers del pool siguen ocupados por modelos descartados
+    """
+    verificar_capacidad_entrenamiento()
+
+    comienzos = {}
+    iniciados = {nombre: threading.Event() for nombre in modelos}
+
+    def entrenar(nombre, modelo):
+        comienzos[nombre] = time.monotonic()
+        iniciados[nombre].set()
+        return entrenar_un_modelo(nombre, modelo, X_train, y_train, X_test, y_test)
+
+    futuros = {}
+    for nombre, modelo in modelos.items():
+        futuros[nombre] = training_executor.submit(entrenar, nombre, modelo)
+        # Un futuro cancelado antes de empezar también libera la espera
+        futuros[nombre].add_done_callback(lambda _, iniciado=iniciados[nombre]: iniciado.set())
+
+    accuracies = {}
+    for nombre, futuro in futuros.items():
+        iniciados[nombre].wait()
+        restante = max(TRAINING_MODEL_TIMEOUT - (time.monotonic() - comienzos.get(nombre, time.monotonic())), 0)
+        try:
+            accuracies[nombre] = futuro.result(timeout=restante)
+        except TimeoutError:
+            # El hilo no se puede interrumpir; su resultado simplemente se ignora
+            abandonar_entrenamiento(futuro)
+            logger.warning(f"Modelo {nombre} descartado: excedió {TRAINING_MODEL_TIMEOUT}s de entrenamiento")
+            metricas.incrementar("clasificador_modelos_descartados_total", modelo=nombre)
+            modelos[nombre] = None
+            accuracies[nombre] = None
+
+    return modelos, accuracies
+
+def ensamble_degradado(modelos: dict) -> bool:
+    """Indica si algún modelo del ensamble se descartó por exceder el tiempo de entrenamiento"""
+    return any(modelo is None for modelo in modelos.values())
+
+def entrenar_modelo_knn(df):
+    """
+    Entrena múltiples modelos de clasificación y evalúa su precisión
+    
+    Los modelos se entrenan en paralelo con un presupuesto de tiempo por modelo.
+    
+    Args:
+        df: DataFrame con datos de entrenamiento
+    Returns:
+        tuple: (modelos entrenados, precisión de cada modelo, scaler)
+    """
+    try:
+        X = df.iloc[:, :-1]
+        y = df.iloc[:, -1]
+        
+        # División de datos en entrenamiento y prueba
+        X_train, X_test, y_train, y_test = model_selection.train_test_split(
+            X, y,
+            test_size=CONFIG_CLASIFICADOR["test_size"],
+            random_state=CONFIG_CLASIFICADOR["random_state"]
+        )
+        
+        # Para mejorar la escala de los datos
+        scaler = preprocessing.MinMaxScaler()
+        X_train = scaler.fit_transform(X_train)
+        X_test = scaler.transform(X_test)
+        
+        modelos = {
+            'knn': ClasificadorVecinos(n_neighbors=3),
+            'bayes': naive_bayes.GaussianNB(),
+            'lda': discriminant_analysis.LinearDiscriminantAnalysis(),
+            'qda': discriminant_analysis.QuadraticDiscriminantAnalysis(),
+            'tree': tree.DecisionTreeClassifier(),
+            'svm': svm.SVC()
+        }
+        
+        modelos, accuracies = entrenar_en_paralelo(modelos, X_train, y_train, X_test, y_test)
+        if all(modelo is None for modelo in modelos.values()):
+            raise RuntimeError("Ningún modelo terminó dentro del presupuesto de tiempo")
+        
+        return modelos, accuracies, scaler
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error al entrenar los modelos: {e}")
+        return None, None, None
+
+class Reservorio:
+    """
+    Muestra uniforme de tamaño fijo sobre un flujo de filas
+
+    Cada fila recibe una prioridad aleatoria y se conservan las de menor
+    prioridad, lo que equivale a un muestreo uniforme sin reemplazo y permite
+    incorporar bloques completos de forma vectorizada.
+    """
+    def __init__(self, capacidad: int, semilla: int):
+        self.capacidad = capacidad
+        self.rng = np.random.default_rng(semilla)
+        self.X = None
+        self.y = None
+        self.prioridades = None
+        self.vistas = 0
+
+    def agregar(self, X: np.ndarray, y: np.ndarray):
+        """Incorpora un bloque de filas a la muestra"""
+        self.vistas += len(X)
+        prioridades = self.rng.random(len(X))
+        if self.X is not None:
+            X = np.concatenate([self.X, X])
+            y = np.concatenate([self.y, y])
+            prioridades = np.concatenate([self.prioridades, prioridades])
+        if len(X) > self.capacidad:
+            conservar = np.argpartition(prioridades, self.capacidad)[:self.capacidad]
+            X, y, prioridades = X[conservar], y[conservar], prioridades[conservar]
+        self.X, self.y, self.prioridades = X, y, prioridades
+
+def filas_de_prueba(inicio: int, n_filas: int) -> np.ndarray:
+    """
+    Decide qué filas forman parte del conjunto de prueba en modo incremental
+
+    La decisión depende solo del índice de la fila (hash multiplicativo), de modo
+    que es la misma en cada pasada sobre el archivo sin guardar ningún estado.
+
+    Returns:
+        np.ndarray: Máscara booleana del bloque
+    """
+    indices = np.arange(inicio, inicio + n_filas, dtype=np.uint64)
+    hash_filas = (indices * np.uint64(2654435761)) % np.uint64(2 ** 32)
+    return hash_filas < np.uint64(CONFIG_CLASIFICADOR["test_size"] * 2 ** 32)
+
+def iterar_bloques_csv(contents: bytes):
+    """
+    Recorre un CSV del clasificador por bloques de TRAINING_CHUNK_ROWS filas
+
+    Yields:
+        tuple: (parámetros del bloque como DataFrame float32, resultados, máscara de prueba)
+    """
+    columnas = pd.read_csv(abrir_buffer(contents), nrows=0).columns
+    tipos = {columna: np.float32 for columna in columnas[:-1]}
+    inicio = 0
+    for bloque in pd.read_csv(abrir_buffer(contents), dtype=tipos, chunksize=TRAINING_CHUNK_ROWS):
+        bloque.columns = bloque.columns.str.strip()
+        yield bloque.iloc[:, :-1], bloque.iloc[:, -1].to_numpy(), filas_de_prueba(inicio, len(bloque))
+        inicio += len(bloque)
+
+def entrenar_modelo_incremental(contents: bytes):
+    """
+    Entrena el ensamble sin cargar el archivo completo en memoria
+
+    Se hacen dos pasadas por bloques sobre el CSV. La primera ajusta el scaler
+    con partial_fit, descubre las clases y mantiene dos reservorios: uno de
+    entrenamiento y otro de prueba. La segunda entrena con partial_fit los
+    modelos que lo admiten: GaussianNB y un SVM lineal por descenso de gradiente
+    en lugar del SVC. Los modelos sin aprendizaje incremental (knn, lda, qda y
+    tree) se ajustan sobre el reservorio de entrenamiento, por lo que la memoria
+    queda acotada por TRAINING_CHUNK_ROWS y TRAINING_RESERVOIR_ROWS.
+
+    Args:
+        contents: Bytes del archivo CSV
+    Returns:
+        tuple: (modelos entrenados, precisión de cada modelo, scaler)
+    """
+    try:
+        semilla = CONFIG_CLASIFICADOR["random_state"]
+        scaler = preprocessing.MinMaxScaler()
+        muestra = Reservorio(TRAINING_RESERVOIR_ROWS, semilla)
+        prueba = Reservorio(TRAINING_RESERVOIR_ROWS, semilla + 1)
+        clases = set()
+
+        with metricas.medir("clasificador_carga_segundos"):
+            for X, y, es_prueba in iterar_bloques_csv(contents):
+                clases.update(np.unique(y).tolist())
+                if (~es_prueba).any():
+                    scaler.partial_fit(X[~es_prueba])
+                    muestra.agregar(X.to_numpy()[~es_prueba], y[~es_prueba])
+                prueba.agregar(X.to_numpy()[es_prueba], y[es_prueba])
+
+        if muestra.X is None or prueba.X is None:
+            raise ValueError("No hay filas suficientes para entrenar y evaluar")
+        clases = np.array(sorted(clases))
+        logger.info(
+            f"Entrenamiento incremental: {muestra.vistas} filas de entrenamiento, "
+            f"{prueba.vistas} de prueba, reservorio de {len(muestra.X)}"
+        )
+
+        incrementales = {
+            'bayes': naive_bayes.GaussianNB(),
+            'svm': linear_model.SGDClassifier(loss="hinge", random_state=semilla)
+        }
+        with metricas.medir("clasificador_entrenamiento_segundos", modelo="incremental"):
+            for X, y, es_prueba in iterar_bloques_csv(contents):
+                if not (~es_prueba).any():
+                    continue
+                X_bloque = scaler.transform(X[~es_prueba])
+                for modelo in incrementales.values():
+                    modelo.partial_fit(X_bloque, y[~es_prueba], classes=clases)
+
+        X_test = scaler.transform(prueba.X)
+        modelos, accuracies = entrenar_en_paralelo(
+            {
+                'knn': ClasificadorVecinos(n_neighbors=3),
+                'lda': discriminant_analysis.LinearDiscriminantAnalysis(),
+                'qda': discriminant_analysis.QuadraticDiscriminantAnalysis(),
+                'tree': tree.DecisionTreeClassifier()
+            },
+            scaler.transform(muestra.X), muestra.y, X_test, prueba.y
+        )
+        for nombre, modelo in incrementales.items():
+            modelos[nombre] = modelo
+            accuracies[nombre] = float(modelo.score(X_test, prueba.y))
+
+        # Mismo orden de modelos que el entrenamiento en memoria
+        orden = ['knn', 'bayes', 'lda', 'qda', 'tree', 'svm']
+        return {nombre: modelos[nombre] for nombre in orden}, {nombre: accuracies[nombre] for nombre in orden}, scaler
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en el entrenamiento incremental: {e}")
+        return None, None, None
+
+def resolver_modo_entrenamiento(contents: bytes, modo: str) -> str:
+    """
+    Determina si un archivo se entrena en memoria o por bloques
+
+    En modo 'auto' los CSV de más de TRAINING_STREAMING_BYTES se entrenan por
+    bloques. Parquet y Feather siempre se cargan en memoria.
+
+    Args:
+        contents: Bytes del archivo
+        modo: 'auto', 'memory' o 'streaming'
+    Returns:
+        str: 'memory' o 'streaming'
+    Raises:
+        HTTPException: Si el modo no es válido o no aplica al formato
+    """
+    if modo not in MODOS_ENTRENAMIENTO:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Modo de entrenamiento no soportado. Use uno de: {', '.join(MODOS_ENTRENAMIENTO)}"
+        )
+    es_csv = detectar_formato_tabla(contents) == "csv"
+    if modo == "streaming" and not es_csv:
+        raise HTTPException(status_code=400, detail="El entrenamiento por bloques solo admite archivos CSV")
+    if modo == "auto":
+        return "streaming" if es_csv and len(contents) > TRAINING_STREAMING_BYTES else "memory"
+    return modo
+
+def clave_clasificador(contents: bytes, modo: str) -> str:
+    """
+    Clave de caché del entrenamiento de un archivo del clasificador
+
+    Args:
+        contents: Bytes del archivo
+        modo: Modo ya resuelto, 'memory' o 'streaming'
+    Returns:
+        str: Clave hexadecimal
+    """
+    config = dict(CONFIG_CLASIFICADOR, modo=modo)
+    if modo == "streaming":
+        config.update(bloque=TRAINING_CHUNK_ROWS, reservorio=TRAINING_RESERVOIR_ROWS)
+    return clave_contenido(contents, config)
+
+def obtener_modelos_clasificador(contents: bytes, modo: str = "auto"):
+    """
+    Obtiene los modelos entrenados para un archivo del clasificador
+    Si el mismo contenido ya fue entrenado se reutilizan los modelos de la caché
+
+    Un ensamble con modelos descartados por tiempo no se guarda en la caché: el
+    descarte depende de la carga del momento. Se conserva aparte durante
+    TRAINING_DEGRADED_TTL segundos, de modo que las peticiones de ese intervalo
+    no vuelven a entrenar ni abandonan más hilos, y después se reentrena.
+
+    Args:
+        contents: Bytes del archivo CSV
+        modo: 'auto', 'memory' o 'streaming'
+    Returns:
+        tuple: (modelos entrenados, precisión de cada modelo, scaler)
+    Raises:
+        HTTPException: Si el archivo no se puede cargar o el entrenamiento falla
+    """
+    modo = resolver_modo_entrenamiento(contents, modo)
+    clave = clave_clasificador(contents, modo)
+    entrenado = model_cache.get(clave)
+    if entrenado is not None:
+        return entrenado
+    degradado = ensambles_degradados.get(clave)
+    if degradado is not None and degradado[1] > time.monotonic():
+        return degradado[0]
+
+    # Antes de leer el archivo, para no cargarlo si no se va a poder entrenar
+    verificar_capacidad_entrenamiento()
+    if modo == "streaming":
+        modelos, accuracies, scaler = entrenar_modelo_incremental(contents)
+    else:
+        df = cargar_datos_desde_excel(contents)
+        if df is None:
+            raise HTTPException(status_code=400, detail="Error al cargar el archivo")
+        modelos, accuracies, scaler = entrenar_modelo_knn(df)
+
+    if modelos is None:
+        raise HTTPException(status_code=500, detail="Error al entrenar los modelos")
+
+    entrenado = (modelos, accuracies, scaler)
+    obtener_ensamble_compilado(modelos, scaler)
+    if ensamble_degradado(modelos):
+        ensambles_degradados.put(clave, (entrenado, time.monotonic() + TRAINING_DEGRADED_TTL))
+    else:
+        model_cache.put(clave, entrenado)
+    return entrenado
+
+# Funciones del sistema experto
+class TablaDecision:
+    """
+    Base de conocimiento del sistema experto compilada en una tabla de reglas
+
+    Cada combinación de respuestas conocida se indexa en un diccionario con la
+    decisión y la confianza que daría el KNN, de modo que una predicción es una
+    búsqueda por hash. Si todas las respuestas son binarias y el número de
+    combinaciones es pequeño se precalculan todas; en otro caso las consultas
+    desconocidas se resuelven con el KNN y se memorizan.
+    """
+    def __init__(self, df: "pd.DataFrame"):
+        self.preguntas = df.columns[:-1].tolist()
+        self.n_preguntas = len(self.preguntas)
+
+        self.label_encoder = preprocessing.LabelEncoder()
+        y = self.label_encoder.fit_transform(df['Decisión'])
+        # Se conserva el tipo de la hoja: el desempate del KNN depende de él
+        X = df.iloc[:, :-1].to_numpy()
+
+        # Sin nombres de columnas para que las consultas no generen advertencias
+        self.knn = ClasificadorVecinos(n_neighbors=CONFIG_EXPERTO["n_neighbors"])
+        with metricas.medir("experto_entrenamiento_segundos"):
+            self.knn.fit(X, y)
+
+        if np.isin(X, (0, 1)).all() and 2 ** self.n_preguntas <= EXPERTO_MAX_COMBINACIONES:
+            # Todas las combinaciones binarias: bits de 0..2^d-1
+            codigos = np.arange(2 ** self.n_preguntas)[:, None]
+            candidatas = ((codigos >> np.arange(self.n_preguntas)[::-1]) & 1).astype(X.dtype)
+            self.completa = True
+        else:
+            candidatas = np.unique(X, axis=0)
+            self.completa = False
+
+        self.reglas = {}
+        with metricas.medir("experto_compilacion_segundos"):
+            self._agregar(candidatas)
+        logger.info(
+            f"Base de conocimiento compilada: {len(self.reglas)} reglas"
+            f"{' (todas las combinaciones)' if self.completa else ''}"
+        )
+
+    def _agregar(self, respuestas: np.ndarray) -> list:
+        """
+        Evalúa el KNN sobre un lote de respuestas y lo incorpora a la tabla
+
+        Returns:
+            list: (decisión, confianza) de cada fila
+        """
+        probabilidades = self.knn.predict_proba(respuestas)
+        decisiones = self.label_encoder.inverse_transform(self.knn.classes_[probabilidades.argmax(axis=1)])
+        resultados = [(decision, float(prob)) for decision, prob in zip(decisiones.tolist(), probabilidades.max(axis=1))]
+        if len(self.reglas) + len(resultados) <= EXPERTO_MAX_REGLAS:
+            self.reglas.update(zip(map(tuple, respuestas.tolist()), resultados))
+        return resultados
+
+    def consultar(self, respuestas: List[float]) -> tuple:
+        """
+        Obtiene la decisión para un conjunto de respuestas
+
+        Args:
+            respuestas: Una respuesta por pregunta
+        Returns:
+            tuple: (decisión, confianza)
+        Raises:
+            HTTPException: Si el número de respuestas no coincide con las preguntas
+        """
+        if len(respuestas) != self.n_preguntas:
+            raise HTTPException(
+                status_code=400,
+                detail="El número de respuestas no coincide con las preguntas del archivo"
+            )
+
+        resultado = self.reglas.get(tuple(respuestas))
+        if resultado is not None:
+            metricas.incrementar("experto_consultas_total", resultado="tabla")
+            return resultado
+
+        metricas.incrementar("experto_consultas_total", resultado="knn")
+        return self._agregar(np.array([respuestas]))[0]
+
+def obtener_modelo_experto(contents: bytes) -> TablaDecision:
+    """
+    Obtiene la tabla de decisión compilada de una base de conocimiento
+    Si el mismo contenido ya fue compilado se reutiliza la tabla de la caché
+
+    Args:
+        contents: Bytes del archivo Excel
+    Returns:
+        TablaDecision: Base de conocimiento compilada
+    Raises:
+        HTTPException: Si la base de conocimiento está vacía
+    """
+    clave = clave_contenido(contents, CONFIG_EXPERTO)
+    tabla = model_cache.get(clave)
+    if tabla is not None:
+        return tabla
+
+    with metricas.medir("experto_carga_segundos"):
+        df = pd.read_excel(abrir_buffer(contents))
+    if df.empty:
+        raise HTTPException(status_code=400, detail="Error al cargar la base de conocimiento")
+
+    tabla = TablaDecision(df)
+    model_cache.put(clave, tabla)
+    return tabla
+
+def formatear_decision_experto(tabla: TablaDecision, respuestas: List[float]) -> dict:
+    """
+    Genera la respuesta de los endpoints de predicción del sistema experto
+
+    Args:
+        tabla: Base de conocimiento compilada
+        respuestas: Una respuesta por pregunta
+    Returns:
+        dict: Decisión y nivel de confianza
+    """
+    with metricas.medir("experto_prediccion_segundos"):
+        decision, max_prob = tabla.consultar(respuestas)
+    nivel_confianza = "alta" if max_prob > 0.8 else "media" if max_prob > 0.6 else "baja"
+
+    return {
+        "decision": decision,
+        "confianza": {
+            "nivel": nivel_confianza,
+            "valor": max_prob
+        }
+    }
+
+MENSAJE_POSITIVO = "Posible caso de diabetes"
+MENSAJE_NEGATIVO = "No se detecta diabetes"
+
+def obtener_modelos_sesion(session: SessionData):
+    """
+    Obtiene los modelos de una sesión del clasificador, entrenándolos la primera vez
+
+    Las sesiones creadas desde un modelo exportado no guardan los modelos: se
+    leen del artefacto mapeado en memoria, compartido por todas las sesiones.
+    Un ensamble con modelos descartados tampoco se guarda en la sesión; durante
+    TRAINING_DEGRADED_TTL segundos se reutiliza desde ensambles_degradados.
+
+    Args:
+        session: Sesión de tipo 'classifier'
+    Returns:
+        tuple: (modelos entrenados, precisión de cada modelo, scaler)
+    """
+    if session.modelo_id is not None:
+        return almacen_modelos.cargar(session.modelo_id)
+    if session.modelos is None:
+        modelos, accuracies, scaler = obtener_modelos_clasificador(session.contenido(), session.modo_entrenamiento)
+        if ensamble_degradado(modelos):
+            return modelos, accuracies, scaler
+        session.modelos = modelos
+        session.accuracies = accuracies
+        session.scaler = scaler
+        session_data.guardar(session)
+    return session.modelos, session.accuracies, session.scaler
+
+def exportar_modelo_sesion(session: SessionData) -> dict:
+    """
+    Exporta el ensamble de una sesión del clasificador a almacen_modelos
+
+    Deriva la clave del contenido (un SHA-256 sobre todo el archivo), lee el
+    encabezado y entrena si hace falta, así que se ejecuta en un hilo.
+
+    Args:
+        session: Sesión de tipo 'classifier'
+    Returns:
+        dict: Metadatos del modelo exportado
+    """
+    if session.modelo_id is not None:
+        return almacen_modelos.metadatos(session.modelo_id)
+
+    contenido = session.contenido()
+    modo = resolver_modo_entrenamiento(contenido, session.modo_entrenamiento)
+    modelo_id = clave_clasificador(contenido, modo)[:32]
+    modelos, accuracies, scaler = obtener_modelos_sesion(session)
+    if ensamble_degradado(modelos):
+        raise HTTPException(
+            status_code=409,
+            detail="Algunos modelos se descartaron por exceder el tiempo de entrenamiento; el ensamble no se exporta"
+        )
+    return almacen_modelos.guardar(
+        modelo_id, modelos, accuracies, scaler,
+        {"modo": modo, "preguntas": leer_encabezado(contenido)[:-1]}
+    )
+
+# Modelos exportados: artefactos joblib versionados en un directorio compartido
+FORMATO_MODELO = 1
+MODELS_DIR = os.getenv("MODELS_DIR") or directorio_privado(os.path.join(directorio_privado(DATA_DIR), "modelos"))
+PATRON_MODELO_ID = re.compile(r"^[0-9a-f]{32}$")
+
+class AlmacenModelos:
+    """
+    Almacén de ensambles entrenados en disco
+
+    Cada modelo se guarda como dos archivos: `<id>.joblib` con los modelos, las
+    precisiones y el scaler, sin comprimir para que los arreglos de NumPy se
+    puedan mapear en memoria, y `<id>.json` con los metadatos. Ambos se escriben
+    con un renombrado atómico y el JSON se escribe al final, así que un modelo
+    solo aparece en el listado cuando está completo.
+
+    Al cargar, los arreglos se mapean en solo lectura: las páginas las comparte
+    el sistema operativo entre todos los workers y la carga no copia los datos.
+    """
+    def __init__(self, ruta: str, max_cargados: int):
+        os.makedirs(ruta, exist_ok=True)
+        self.ruta = ruta
+        # Los arreglos mapeados viven en la caché de páginas del sistema, no en la
+        # memoria del proceso, por lo que los modelos cargados solo se limitan en número
+        self._cargados = CacheLRU(max_entradas=max_cargados, max_bytes=sys.maxsize)
+
+    def _archivo(self, modelo_id: str, extension: str) -> str:
+        if not PATRON_MODELO_ID.match(modelo_id or ""):
+            raise HTTPException(status_code=404, detail="Modelo no encontrado")
+        return os.path.join(self.ruta, f"{modelo_id}{extension}")
+
+    def _escribir(self, archivo: str, escribir):
+        temporal = f"{archivo}.{uuid.uuid4().hex}.tmp"
+        try:
+            escribir(temporal)
+            os.replace(temporal, archivo)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+
+    def guardar(self, modelo_id: str, modelos: dict, accuracies: dict, scaler, metadatos: dict) -> dict:
+        """
+        Exporta un ensamble entrenado
+
+        Args:
+            modelo_id: Identificador del modelo
+            modelos: Diccionario de modelos entrenados
+            accuracies: Precisión de cada modelo
+            scaler: Scaler ajustado durante el entrenamiento
+            metadatos: Datos descriptivos que se guardan junto al artefacto
+        Returns:
+            dict: Metadatos del modelo exportado
+        """
+        artefacto = self._archivo(modelo_id, ".joblib")
+        contenido = {
+            "formato": FORMATO_MODELO,
+            "modelos": modelos,
+            "accuracies": accuracies,
+            "scaler": scaler
+        }
+        with metricas.medir("modelos_exportacion_segundos"):
+            self._escribir(artefacto, lambda ruta: joblib.dump(contenido, ruta))
+
+        metadatos = dict(
+            metadatos,
+            id=modelo_id,
+            formato=FORMATO_MODELO,
+            creado=datetime.now().isoformat(),
+            bytes=os.path.getsize(artefacto),
+            modelos={nombre: {"accuracy": accuracies.get(nombre), "descartado": modelo is None}
+                     for nombre, modelo in modelos.items()},
+            versiones={"sklearn": sklearn.__version__, "numpy": np.__version__}
+        )
+
+        def escribir_json(ruta: str):
+            with open(ruta, "w", encoding="utf-8") as f:
+                json.dump(metadatos, f)
+
+        self._escribir(self._archivo(modelo_id, ".json"), escribir_json)
+        logger.info(f"Modelo {modelo_id} exportado ({metadatos['bytes']} bytes)")
+        return metadatos
+
+    def metadatos(self, modelo_id: str) -> dict:
+        """
+        Lee los metadatos de un modelo exportado
+
+        Raises:
+            HTTPException: Si el modelo no existe
+        """
+        try:
+            with open(self._archivo(modelo_id, ".json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Modelo no encontrado")
+
+    def listar(self) -> List[dict]:
+        """Metadatos de todos los modelos exportados, del más reciente al más antiguo"""
+        modelos = []
+        for entrada in os.scandir(self.ruta):
+            modelo_id, extension = os.path.splitext(entrada.name)
+            if extension != ".json" or not PATRON_MODELO_ID.match(modelo_id):
+                continue
+            try:
+                modelos.append(self.metadatos(modelo_id))
+            except (HTTPException, ValueError) as e:
+                logger.warning(f"Metadatos ilegibles para el modelo {modelo_id}: {e}")
+        return sorted(modelos, key=lambda m: m.get("creado", ""), reverse=True)
+
+    def cargar(self, modelo_id: str) -> tuple:
+        """
+        Carga un modelo exportado con sus arreglos mapeados en memoria
+
+        Args:
+            modelo_id: Identificador del modelo
+        Returns:
+            tuple: (modelos entrenados, precisión de cada modelo, scaler)
+        Raises:
+            HTTPException: Si el modelo no existe o su formato no es compatible
+        """
+        cargado = self._cargados.get(modelo_id)
+        if cargado is not None:
+            return cargado
+
+        metadatos = self.metadatos(modelo_id)
+        if metadatos.get("formato") != FORMATO_MODELO:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Formato de modelo {metadatos.get('formato')} no soportado; se esperaba {FORMATO_MODELO}"
+            )
+        version = metadatos.get("versiones", {}).get("sklearn")
+        if version != sklearn.__version__:
+            logger.warning(f"Modelo {modelo_id} exportado con sklearn {version}; instalado {sklearn.__version__}")
+
+        try:
+            with metricas.medir("modelos_carga_segundos"):
+                contenido = joblib.load(self._archivo(modelo_id, ".joblib"), mmap_mode="r")
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Modelo no encontrado")
+
+        cargado = (contenido["modelos"], contenido["accuracies"], contenido["scaler"])
+        obtener_ensamble_compilado(cargado[0], cargado[2])
+        self._cargados.put(modelo_id, cargado, tamano=0)
+        return cargado
+
+almacen_modelos = AlmacenModelos(
+    ruta=MODELS_DIR,
+    max_cargados=int(os.getenv("MODELS_MAX_LOADED", "16"))
+)
+
+# Inferencia del ensamble: 'compiled' usa el núcleo NumPy, 'sklearn' llama a cada modelo
+MODOS_INFERENCIA = ("compiled", "sklearn")
+CLASSIFIER_INFERENCE = os.getenv("CLASSIFIER_INFERENCE", "compiled")
+
+def compilar_lineal(modelo):
+    """LDA y SGDClassifier: producto por coef_ y signo o argmax"""
+    coef = np.ascontiguousarray(modelo.coef_.T, dtype=np.float64)
+    intercepto = np.asarray(modelo.intercept_, dtype=np.float64)
+    clases = modelo.classes_
+    if coef.shape[1] == 1:
+        return lambda X: clases[(X @ coef[:, 0] + intercepto[0] > 0).astype(np.intp)]
+    return lambda X: clases[(X @ coef + intercepto).argmax(axis=1)]
+
+def compilar_bayes(modelo):
+    """GaussianNB: log-verosimilitud conjunta con los términos constantes precalculados"""
+    theta = modelo.theta_
+    varianza = modelo.var_
+    constante = np.log(modelo.class_prior_) - 0.5 * np.log(2.0 * np.pi * modelo.var_).sum(axis=1)
+    clases = modelo.classes_
+
+    def predecir(X):
+        diferencias = X[:, None, :] - theta
+        return clases[(constante - 0.5 * (diferencias ** 2 / varianza).sum(axis=2)).argmax(axis=1)]
+    return predecir
+
+def compilar_qda(modelo):
+    """QDA: proyección por clase con rotación y escalado combinados en una matriz"""
+    medias = modelo.means_
+    proyecciones = [R * (S ** -0.5) for R, S in zip(modelo.rotations_, modelo.scalings_)]
+    constante = np.log(modelo.priors_) - 0.5 * np.array([np.log(S).sum() for S in modelo.scalings_])
+    clases = modelo.classes_
+
+    def predecir(X):
+        norma = np.column_stack([
+            ((X - media) @ proyeccion) ** 2 @ np.ones(proyeccion.shape[1])
+            for media, proyeccion in zip(medias, proyecciones)
+        ])
+        return clases[(constante - 0.5 * norma).argmax(axis=1)]
+    return predecir
+
+def compilar_arbol(modelo):
+    """Árbol de decisión: recorrido por niveles de todas las filas a la vez"""
+    arbol = modelo.tree_
+    izquierda, derecha = arbol.children_left, arbol.children_right
+    caracteristica = np.maximum(arbol.feature, 0)
+    umbral = arbol.threshold
+    hoja = izquierda == -1
+    clase_hoja = modelo.classes_[arbol.value[:, 0, :].argmax(axis=1)]
+
+    def predecir(X):
+        # sklearn compara en float32
+        X = X.astype(np.float32)
+        filas = np.arange(len(X))
+        nodo = np.zeros(len(X), dtype=np.intp)
+        activas = filas
+        while activas.size:
+            actual = nodo[activas]
+            menor = X[activas, caracteristica[actual]] <= umbral[actual]
+            siguiente = np.where(menor, izquierda[actual], derecha[actual])
+            nodo[activas] = siguiente
+            activas = activas[~hoja[siguiente]]
+        return clase_hoja[nodo]
+    return predecir
+
+# Filas de referencia (vectores de soporte o puntos del KNN) que se convierten a float64 a la vez
+BLOQUE_REFERENCIA = 65536
+
+def normas_cuadradas(referencia: np.ndarray) -> np.ndarray:
+    """Norma al cuadrado de cada fila en float64, convirtiendo la referencia por bloques"""
+    normas = np.empty(len(referencia), dtype=np.float64)
+    for inicio in range(0, len(referencia), BLOQUE_REFERENCIA):
+        bloque = np.asarray(referencia[inicio:inicio + BLOQUE_REFERENCIA], dtype=np.float64)
+        normas[inicio:inicio + len(bloque)] = (bloque ** 2).sum(axis=1)
+    return normas
+
+def producto_referencia(X: np.ndarray, referencia: np.ndarray) -> np.ndarray:
+    """
+    X @ referencia.T en float64 sin copiar la referencia completa
+
+    Los modelos cargados con AlmacenModelos guardan la referencia como un
+    memmap float32 compartido entre workers; convertirla entera crearía una
+    copia privada del doble de tamaño en cada proceso, así que se convierte
+    por bloques en cada llamada.
+    """
+    if referencia.dtype == np.float64:
+        return X @ referencia.T
+    resultado = np.empty((len(X), len(referencia)), dtype=np.float64)
+    for inicio in range(0, len(referencia), BLOQUE_REFERENCIA):
+        bloque = np.asarray(referencia[inicio:inicio + BLOQUE_REFERENCIA], dtype=np.float64)
+        resultado[:, inicio:inicio + len(bloque)] = X @ bloque.T
+    return resultado
+
+def compilar_svc(modelo):
+    """SVC binario con kernel RBF: suma ponderada de kernels sobre los vectores de soporte"""
+    if modelo.kernel != "rbf" or len(modelo.classes_) != 2:
+        return None
+    soporte = modelo.support_vectors_
+    normas = normas_cuadradas(soporte)
+    coeficientes = modelo.dual_coef_[0]
+    intercepto = modelo.intercept_[0]
+    gamma = modelo._gamma
+    clases = modelo.classes_
+
+    def predecir(X):
+        distancias = (X ** 2).sum(axis=1)[:, None] + normas - 2.0 * producto_referencia(X, soporte)
+        decision = np.exp(-gamma * np.maximum(distancias, 0)) @ coeficientes + intercepto
+        return clases[(decision > 0).astype(np.intp)]
+    return predecir
+
+def compilar_vecinos(modelo):
+    """KNN exacto por fuerza bruta; los índices brute e ivf ya evalúan en NumPy"""
+    if not isinstance(modelo, ClasificadorVecinos):
+        return None
+    if modelo.backend != "exact":
+        return modelo.predict
+    knn = modelo._sklearn
+    puntos = knn._fit_X
+    normas = normas_cuadradas(puntos)
+    codigos = knn._y
+    clases = knn.classes_
+    k = knn.n_neighbors
+
+    def predecir(X):
+        distancias = normas - 2.0 * producto_referencia(X, puntos)
+        vecinos = np.argpartition(distancias, k - 1, axis=1)[:, :k]
+        conteos = np.zeros((len(X), len(clases)), dtype=np.intp)
+        np.add.at(conteos, (np.arange(len(X))[:, None], codigos[vecinos]), 1)
+        return clases[conteos.argmax(axis=1)]
+    return predecir
+
+def compilar_modelo(modelo):
+    """
+    Extrae los parámetros de un modelo entrenado a una función NumPy sin validaciones
+
+    Returns:
+        callable: Función que recibe la matriz ya escalada y devuelve las clases;
+                  si el modelo no tiene núcleo compilado se usa su predict
+    """
+    if isinstance(modelo, naive_bayes.GaussianNB):
+        compilado = compilar_bayes(modelo)
+    elif isinstance(modelo, discriminant_analysis.QuadraticDiscriminantAnalysis):
+        compilado = compilar_qda(modelo)
+    elif isinstance(modelo, (discriminant_analysis.LinearDiscriminantAnalysis, linear_model.SGDClassifier)):
+        compilado = compilar_lineal(modelo)
+    elif isinstance(modelo, tree.DecisionTreeClassifier):
+        compilado = compilar_arbol(modelo)
+    elif isinstance(modelo, svm.SVC):
+        compilado = compilar_svc(modelo)
+    else:
+        compilado = compilar_vecinos(modelo)
+    return compilado or modelo.predict
+
+class EnsambleCompilado:
+    """
+    Núcleo de inferencia del ensamble creado una vez tras el entrenamiento
+
+    Guarda el escalado min-max y los parámetros de cada modelo como arreglos de
+    NumPy y evalúa el escalado, todos los modelos y el voto sin pasar por las
+    validaciones de sklearn, que dominan la latencia de una sola fila.
+    """
+    def __init__(self, modelos: dict, scaler):
+        self.modelos = modelos
+        self.escala = np.asarray(scaler.scale_, dtype=np.float64)
+        self.minimo = np.asarray(scaler.min_, dtype=np.float64)
+        self.nombres = [nombre for nombre, modelo in modelos.items() if modelo is not None]
+        self._funciones = [compilar_modelo(modelos[nombre]) for nombre in self.nombres]
+        # Bloques de filas para acotar las matrices de kernels y distancias a ~16M elementos
+        ancho = max(
+            [len(modelo.support_vectors_) for modelo in modelos.values() if isinstance(modelo, svm.SVC)]
+            + [len(modelo._sklearn._fit_X) for modelo in modelos.values()
+               if isinstance(modelo, ClasificadorVecinos) and modelo.backend == "exact"]
+            + [1]
+        )
+        self.tamano_bloque = max(1, (1 << 24) // ancho)
+
+    def predecir(self, matriz: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            matriz: Matriz (n_filas, n_parametros) sin escalar
+        Returns:
+            np.ndarray: Predicciones (n_modelos, n_filas)
+        """
+        X = matriz * self.escala + self.minimo
+        predicciones = np.empty((len(self._funciones), len(X)), dtype=np.int64)
+        for inicio in range(0, len(X), self.tamano_bloque):
+            bloque = X[inicio:inicio + self.tamano_bloque]
+            for i, funcion in enumerate(self._funciones):
+                predicciones[i, inicio:inicio + len(bloque)] = funcion(bloque)
+        return predicciones
+
+# Núcleos compilados indexados por el scaler, que es único por entrenamiento
+ensambles_compilados = weakref.WeakKeyDictionary()
+ensambles_lock = threading.Lock()
+
+def obtener_ensamble_compilado(modelos: dict, scaler) -> EnsambleCompilado:
+    """Devuelve el núcleo compilado de un ensamble, creándolo la primera vez"""
+    with ensambles_lock:
+        ensamble = ensambles_compilados.get(scaler)
+        if ensamble is None or ensamble.modelos is not modelos:
+            ensamble = ensambles_compilados[scaler] = EnsambleCompilado(modelos, scaler)
+        return ensamble
+
+def predecir_ensamble(modelos: dict, scaler, respuestas) -> tuple:
+    """
+    Predice un lote de respuestas con todos los modelos y aplica el voto mayoritario
+
+    Cada modelo se evalúa una sola vez sobre la matriz completa ya escalada y el
+    voto se calcula de forma vectorizada. Con CLASSIFIER_INFERENCE=compiled el
+    escalado y los modelos se evalúan con el núcleo NumPy del ensamble. Los
+    modelos descartados durante el entrenamiento no votan.
+
+    Args:
+        modelos: Diccionario de modelos entrenados
+        scaler: Scaler ajustado durante el entrenamiento
+        respuestas: Matriz (n_filas, n_parametros) con las respuestas
+    Returns:
+        tuple: (nombres de los modelos que votan, matriz (n_modelos, n_filas) de
+                predicciones, votos positivos por fila, decisión positiva por fila)
+    """
+    try:
+        matriz = np.asarray(respuestas, dtype=np.float64)
+    except ValueError:
+        # Filas de distinta longitud
+        matriz = np.empty(0)
+    if matriz.ndim != 2 or matriz.shape[1] != scaler.n_features_in_:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Se esperaban {scaler.n_features_in_} parámetros por fila"
+        )
+
+    if CLASSIFIER_INFERENCE == "compiled":
+        ensamble = obtener_ensamble_compilado(modelos, scaler)
+        nombres = ensamble.nombres
+        with metricas.medir("clasificador_prediccion_segundos", modelo="ensamble"):
+            predicciones = ensamble.predecir(matriz)
+    else:
+        respuestas_norm = scaler.transform(matriz)
+        nombres = [nombre for nombre, modelo in modelos.items() if modelo is not None]
+        filas = []
+        for nombre in nombres:
+            with metricas.medir("clasificador_prediccion_segundos", modelo=nombre):
+                filas.append(np.asarray(modelos[nombre].predict(respuestas_norm)).astype(np.int64))
+        predicciones = np.vstack(filas)
+
+    votos_positivos = (predicciones == 1).sum(axis=0)
+    positivos = votos_positivos > len(nombres) / 2
+    return nombres, predicciones, votos_positivos, positivos
+
+# Entrada de predicciones_por_modelo para un modelo que no votó
+MODELO_DESCARTADO = {
+    "mensaje": "Modelo descartado: excedió el presupuesto de entrenamiento",
+    "valor": None,
+    "accuracy": None,
+    "descartado": True
+}
+
+def formatear_prediccion(respuestas: List[float], modelos: dict, accuracies: dict, scaler) -> dict:
+    """
+    Genera la respuesta de los endpoints de predicción individual
+
+    Args:
+        respuestas: Respuestas de un único caso
+        modelos: Diccionario de modelos entrenados
+        accuracies: Precisión de cada modelo
+        scaler: Scaler ajustado durante el entrenamiento
+    Returns:
+        dict: Decisión final y predicción de cada modelo
+    """
+    nombres, predicciones, _, positivos = predecir_ensamble(modelos, scaler, [respuestas])
+
+    predicciones_por_modelo = {}
+    for nombre in modelos:
+        if nombre not in nombres:
+            predicciones_por_modelo[nombre] = dict(MODELO_DESCARTADO)
+            continue
+        pred_valor = int(predicciones[nombres.index(nombre), 0])
+        predicciones_por_modelo[nombre] = {
+            "mensaje": MENSAJE_POSITIVO if pred_valor == 1 else MENSAJE_NEGATIVO,
+            "valor": pred_valor,
+            "accuracy": accuracies[nombre]
+        }
+
+    return {
+        "decision": MENSAJE_POSITIVO if positivos[0] else MENSAJE_NEGATIVO,
+        "predicciones_por_modelo": predicciones_por_modelo
+    }
+
+def formatear_prediccion_lote(respuestas, modelos: dict, accuracies: dict, scaler) -> dict:
+    """
+    Genera la respuesta de los endpoints de predicción por lotes
+
+    Args:
+        respuestas: Matriz (n_filas, n_parametros) con las respuestas
+        modelos: Diccionario de modelos entrenados
+        accuracies: Precisión de cada modelo
+        scaler: Scaler ajustado durante el entrenamiento
+    Returns:
+        dict: Decisiones por fila y predicciones de cada modelo
+    """
+    nombres, predicciones, votos_positivos, positivos = predecir_ensamble(modelos, scaler, respuestas)
+
+    predicciones_por_modelo = {}
+    for nombre in modelos:
+        if nombre not in nombres:
+            predicciones_por_modelo[nombre] = {"valores": None, "accuracy": None, "descartado": True}
+            continue
+        predicciones_por_modelo[nombre] = {
+            "valores": predicciones[nombres.index(nombre)].tolist(),
+            "accuracy": accuracies[nombre]
+        }
+
+    return {
+        "total": int(positivos.shape[0]),
+        "decisiones": np.where(positivos, MENSAJE_POSITIVO, MENSAJE_NEGATIVO).tolist(),
+        "valores": positivos.astype(np.int64).tolist(),
+        "votos_positivos": votos_positivos.tolist(),
+        "predicciones_por_modelo": predicciones_por_modelo
+    }
+
+def cargar_respuestas_lote(contents: bytes, scaler) -> np.ndarray:
+    """
+    Carga un CSV de respuestas con las mismas columnas que el archivo de entrenamiento
+
+    La columna de resultado es opcional; si está presente se ignora.
+
+    Args:
+        contents: Bytes del CSV de respuestas
+        scaler: Scaler ajustado durante el entrenamiento
+    Returns:
+        np.ndarray: Matriz (n_filas, n_parametros) en el orden del entrenamiento
+    """
+    df = cargar_datos_desde_excel(contents)
+    if df is None:
+        raise HTTPException(status_code=400, detail="Error al cargar el archivo de respuestas")
+
+    columnas = getattr(scaler, 'feature_names_in_', None)
+    if columnas is not None:
+        faltantes = [col for col in columnas if col not in df.columns]
+        if faltantes:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Faltan columnas en el archivo de respuestas: {faltantes}"
+            )
+        return df[list(columnas)].to_numpy(dtype=np.float64)
+
+    return df.iloc[:, :scaler.n_features_in_].to_numpy(dtype=np.float64)
+
+# Funciones de procesamiento de imágenes
+# Formatos de imagen soportados: extensión, tipo MIME y nombre del parámetro de calidad de OpenCV
+FORMATOS_IMAGEN = {
+    "jpeg": {"extension": ".jpg", "media_type": "image/jpeg", "calidad": "IMWRITE_JPEG_QUALITY"},
+    "webp": {"extension": ".webp", "media_type": "image/webp", "calidad": "IMWRITE_WEBP_QUALITY"},
+    "png": {"extension": ".png", "media_type": "image/png", "calidad": None},
+    # PNG indexado: mapa de etiquetas de 8 bits más la paleta de centroides, sin pérdida
+    "palette": {"extension": ".png", "media_type": "image/png", "calidad": None},
+}
+
+# Lado mayor por defecto de las imágenes procesadas
+DIMENSION_MAXIMA = 800
+# Lado mayor de la versión reducida sobre la que se ajustan las paletas
+DIMENSION_AJUSTE = 800
+# Píxeles por franja al asignar y codificar la imagen completa
+PIXELES_POR_FRANJA = 1 << 18
+
+# Perfiles de ajuste de K-means: sobre qué píxeles se ajusta y cuándo se detiene
+#   muestra: número de píxeles aleatorios (None: todos)
+#   histograma: ajusta sobre los colores distintos ponderados por su frecuencia
+#   max_iter, tol, max_no_improvement: parada de MiniBatchKMeans; max_no_improvement
+#       detiene el ajuste cuando la inercia deja de mejorar
+PERFILES_AJUSTE = {
+    "fast": {"muestra": None, "histograma": True, "max_iter": 50, "tol": 1e-3, "max_no_improvement": 3},
+    "balanced": {"muestra": 20000, "histograma": False, "max_iter": 100, "tol": 1e-4, "max_no_improvement": 5},
+    "exact": {"muestra": None, "histograma": False, "max_iter": 300, "tol": 0.0, "max_no_improvement": 10}
+}
+
+class OpcionesBarrido:
+    """
+    Opciones de un barrido de K-means que afectan a su resultado
+    
+    Args:
+        incremental: Reutiliza la paleta de k-1 como punto de partida para k
+        formato: Formato de las imágenes generadas ('jpeg' | 'webp' | 'png' | 'palette')
+        calidad: Calidad de compresión para JPEG y WebP (1-100)
+        ajuste: Perfil de ajuste de K-means ('fast' | 'balanced' | 'exact')
+        dimension: Lado mayor de la imagen de salida; 0 conserva la resolución original
+    """
+    def __init__(self, incremental: bool = True, formato: str = "jpeg", calidad: int = 85,
+                 ajuste: str = "balanced", dimension: int = None):
+        if formato not in FORMATOS_IMAGEN:
+            raise ValueError(f"Formato de imagen no soportado: {formato}")
+        if ajuste not in PERFILES_AJUSTE:
+            raise ValueError(f"Perfil de ajuste no soportado: {ajuste}. Use uno de: {', '.join(PERFILES_AJUSTE)}")
+        dimension = DIMENSION_MAXIMA if dimension is None else dimension
+        if dimension < 0:
+            raise ValueError("La dimensión máxima no puede ser negativa")
+        self.incremental = incremental
+        self.formato = formato
+        self.calidad = calidad
+        self.ajuste = ajuste
+        self.dimension = dimension
+
+    @property
+    def perfil(self) -> dict:
+        """Parámetros del perfil de ajuste"""
+        return PERFILES_AJUSTE[self.ajuste]
+
+def codificar_png_indexado(etiquetas: np.ndarray, paleta: np.ndarray) -> bytes:
+    """
+    Codifica un mapa de etiquetas como PNG indexado con la paleta de centroides
+    
+    Cada píxel ocupa un byte y los colores se guardan una sola vez en el bloque
+    PLTE, por lo que el resultado es sin pérdida y mucho más pequeño que la
+    imagen RGB. Cualquier navegador lo muestra directamente. Las filas se
+    comprimen por franjas para no duplicar el mapa de etiquetas en memoria.
+    
+    Args:
+        etiquetas: Mapa de etiquetas (alto, ancho) con valores menores que 256
+        paleta: Colores RGB (k, 3) en uint8
+        
+    Returns:
+        bytes: archivo PNG
+    """
+    alto, ancho = etiquetas.shape
+    compresor = zlib.compressobj(6)
+    comprimido = []
+    filas_por_franja = max(1, PIXELES_POR_FRANJA // (ancho + 1))
+    for inicio in range(0, alto, filas_por_franja):
+        franja = etiquetas[inicio:inicio + filas_por_franja]
+        filas = np.zeros((franja.shape[0], ancho + 1), dtype=np.uint8)
+        filas[:, 1:] = franja
+        comprimido.append(compresor.compress(filas.tobytes()))
+    comprimido.append(compresor.flush())
+    
+    def bloque(tipo: bytes, datos: bytes) -> bytes:
+        crc = zlib.crc32(tipo + datos) & 0xffffffff
+        return struct.pack(">I", len(datos)) + tipo + datos + struct.pack(">I", crc)
+    
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + bloque(b"IHDR", struct.pack(">IIBBBBB", ancho, alto, 8, 3, 0, 0, 0))
+        + bloque(b"PLTE", np.ascontiguousarray(paleta, dtype=np.uint8).tobytes())
+        + bloque(b"IDAT", b"".join(comprimido))
+        + bloque(b"IEND", b"")
+    )
+
+def codificar_resultado(centroides: np.ndarray, etiquetas: np.ndarray, opciones: OpcionesBarrido) -> dict:
+    """
+    Reconstruye la imagen cuantizada y la codifica en el formato pedido
+    
+    La imagen se obtiene indexando la paleta en uint8 con el mapa de etiquetas,
+    directamente en BGR, sin pasar por float ni por conversiones de color.
+    
+    Args:
+        centroides: Colores BGR de los clusters normalizados entre 0 y 1
+        etiquetas: Mapa de etiquetas (alto, ancho)
+        opciones: Opciones del barrido con el formato y la calidad
+        
+    Returns:
+        dict: {"image": bytes de la imagen codificada}, más "palette" con los
+            colores RGB en el formato 'palette'
+    """
+    paleta = np.rint(np.clip(centroides * 255, 0, 255)).astype(np.uint8)
+    
+    if opciones.formato == "palette":
+        paleta_rgb = np.ascontiguousarray(paleta[:, ::-1])
+        with metricas.medir("imagen_codificacion_segundos", formato=opciones.formato):
+            imagen = codificar_png_indexado(etiquetas, paleta_rgb)
+        return {"image": imagen, "palette": paleta_rgb.tolist()}
+    
+    img_resultado = paleta[etiquetas]
+    
+    config = FORMATOS_IMAGEN[opciones.formato]
+    parametros = [getattr(cv2, config["calidad"]), opciones.calidad] if config["calidad"] is not None else []
+    with metricas.medir("imagen_codificacion_segundos", formato=opciones.formato):
+        _, buffer = cv2.imencode(config["extension"], img_resultado, parametros)
+    
+    return {"image": buffer.tobytes()}
+
+def a_data_uri(imagen: bytes, formato: str = "jpeg") -> str:
+    """Convierte una imagen codificada en un data URI en base64"""
+    with metricas.medir("imagen_base64_segundos"):
+        img_base64 = base64.b64encode(imagen).decode('utf-8')
+    return f"data:{FORMATOS_IMAGEN[formato]['media_type']};base64,{img_base64}"
+
+def serializar_resultado(resultado: dict, formato: str) -> dict:
+    """Convierte un resultado del barrido en un diccionario apto para JSON"""
+    serializado = {"k": resultado["k"], "image": a_data_uri(resultado["image"], formato)}
+    if "palette" in resultado:
+        serializado["palette"] = resultado["palette"]
+    return serializado
+
+def convertir_formato(imagen: bytes, formato: str, calidad: int = 85) -> bytes:
+    """
+    Recodifica una imagen ya generada en otro formato
+    
+    Permite reconstruir bajo demanda un JPEG, WebP o PNG RGB a partir de un PNG indexado.
+    """
+    img = cv2.imdecode(np.frombuffer(imagen, np.uint8), cv2.IMREAD_COLOR)
+    config = FORMATOS_IMAGEN[formato]
+    parametros = [getattr(cv2, config["calidad"]), calidad] if config["calidad"] is not None else []
+    _, buffer = cv2.imencode(config["extension"], img, parametros)
+    return buffer.tobytes()
+
+def crear_kmeans(k: int, opciones: OpcionesBarrido, init=None) -> "cluster.MiniBatchKMeans":
+    """
+    Crea el modelo K-means con la parada temprana del perfil de ajuste
+    
+    Args:
+        k: Número de clusters
+        opciones: Opciones del barrido
+        init: Centroides iniciales; si se omite se usa k-means++
+    """
+    perfil = opciones.perfil
+    extra = {"init": init, "n_init": 1} if init is not None else {}
+    return cluster.MiniBatchKMeans(
+        n_clusters=k,
+        batch_size=1024,
+        random_state=42,
+        max_iter=perfil["max_iter"],
+        tol=perfil["tol"],
+        max_no_improvement=perfil["max_no_improvement"],
+        **extra
+    )
+
+def ajustar_kmeans(modelo_cluster: "cluster.MiniBatchKMeans", muestra: np.ndarray, pesos: np.ndarray = None) -> np.ndarray:
+    """
+    Ajusta el modelo sobre la muestra y devuelve sus centroides
+    
+    Si la muestra tiene menos puntos que clusters (imágenes con pocos colores
+    en modo histograma) se repiten los puntos repartiendo su peso.
+    """
+    k = modelo_cluster.n_clusters
+    if muestra.shape[0] < k:
+        repeticiones = -(-k // muestra.shape[0])
+        muestra = np.repeat(muestra, repeticiones, axis=0)
+        if pesos is not None:
+            pesos = np.repeat(pesos / repeticiones, repeticiones)
+    modelo_cluster.fit(muestra, sample_weight=pesos)
+    return modelo_cluster.cluster_centers_.astype(np.float32)
+
+def process_single_kmeans(args):
+    """
+    Procesa una imagen con K-means para un valor específico de k
+    
+    El ajuste se hace sobre los puntos del perfil y después se asignan todos
+    los píxeles por franjas.
+    
+    Args:
+        args: tupla (imagen, k, opciones)
+        
+    Returns:
+        dict: imagen procesada codificada
+    """
+    imagen, k, opciones = args
+    logger.info(f"Iniciando clustering con k={k}")
+    
+    try:
+        muestra, pesos = muestra_de_ajuste(imagen, opciones)
+        with metricas.medir("imagen_ajuste_segundos", modo="independiente"):
+            centroides = ajustar_kmeans(crear_kmeans(k, opciones), muestra, pesos)
+        with metricas.medir("imagen_asignacion_segundos"):
+            etiquetas = asignar_imagen(imagen, centroides)
+        resultado = codificar_resultado(centroides, etiquetas, opciones)
+        resultado["centroides"] = centroides
+        return resultado
+    except Exception as e:
+        logger.error(f"Error en clustering k={k}: {str(e)}")
+        raise
+
+# Número de píxeles de la muestra compartida por todo el barrido incremental
+TAMANO_MUESTRA_PIXELES = PERFILES_AJUSTE["balanced"]["muestra"]
+
+def muestrear_pixeles(dataset: np.ndarray, tamano: int = TAMANO_MUESTRA_PIXELES) -> np.ndarray:
+    """
+    Obtiene una muestra aleatoria reproducible de los píxeles de la imagen
+    
+    Args:
+        dataset: Píxeles (n_pixeles, canales)
+        tamano: Número máximo de píxeles de la muestra
+        
+    Returns:
+        np.ndarray: Muestra de píxeles
+    """
+    if dataset.shape[0] <= tamano:
+        return dataset
+    indices = np.random.default_rng(42).choice(dataset.shape[0], size=tamano, replace=False)
+    return dataset[indices]
+
+def histograma_colores(pixeles: np.ndarray, bits: int = 5) -> tuple:
+    """
+    Reduce los píxeles a sus colores distintos ponderados por frecuencia
+    
+    Cada canal se cuantiza a `bits` bits y cada celda del histograma se
+    representa por el color medio de sus píxeles, por lo que el ajuste trabaja
+    con a lo sumo 2^(3*bits) puntos sea cual sea el tamaño de la imagen.
+    
+    Args:
+        pixeles: Píxeles en uint8 (n_pixeles, 3)
+        bits: Bits por canal del histograma
+        
+    Returns:
+        tuple: (colores medios normalizados (n_colores, 3), número de píxeles de cada color)
+    """
+    niveles = pixeles >> (8 - bits)
+    celdas = (
+        (niveles[:, 0].astype(np.int32) << (2 * bits))
+        | (niveles[:, 1].astype(np.int32) << bits)
+        | niveles[:, 2]
+    )
+    conteos = np.bincount(celdas, minlength=1 << (3 * bits))
+    ocupadas = np.flatnonzero(conteos)
+    colores = np.stack(
+        [np.bincount(celdas, weights=pixeles[:, canal], minlength=conteos.size)[ocupadas] for canal in range(3)],
+        axis=1
+    ) / (conteos[ocupadas, None] * 255.0)
+    return colores.astype(np.float32), conteos[ocupadas].astype(np.float64)
+
+def reducir_imagen(imagen: np.ndarray, dimension: int) -> np.ndarray:
+    """
+    Reduce la imagen para que su lado mayor no supere la dimensión indicada
+    
+    Args:
+        imagen: Imagen (alto, ancho, canales)
+        dimension: Lado mayor permitido; 0 no reduce
+        
+    Returns:
+        np.ndarray: La misma imagen o una copia reducida
+    """
+    alto, ancho = imagen.shape[:2]
+    if not dimension or max(alto, ancho) <= dimension:
+        return imagen
+    escala = dimension / max(alto, ancho)
+    with metricas.medir("imagen_redimension_segundos"):
+        return cv2.resize(imagen, (int(ancho * escala), int(alto * escala)))
+
+def muestra_de_ajuste(imagen: np.ndarray, opciones: OpcionesBarrido) -> tuple:
+    """
+    Obtiene los puntos sobre los que se ajusta K-means según el perfil
+    
+    El ajuste siempre trabaja sobre una versión de a lo sumo DIMENSION_AJUSTE
+    píxeles de lado, de modo que su coste no depende de la resolución de salida.
+    
+    Args:
+        imagen: Imagen BGR en uint8
+        opciones: Opciones del barrido con el perfil de ajuste
+        
+    Returns:
+        tuple: (puntos BGR normalizados, peso de cada punto o None)
+    """
+    perfil = opciones.perfil
+    pixeles = reducir_imagen(imagen, DIMENSION_AJUSTE).reshape(-1, 3)
+    if perfil["histograma"]:
+        return histograma_colores(pixeles)
+    if perfil["muestra"] is not None:
+        pixeles = muestrear_pixeles(pixeles, perfil["muestra"])
+    return pixeles.astype(np.float32) / 255.0, None
+
+def asignar_centroides(dataset: np.ndarray, centroides: np.ndarray, tamano_bloque: int = 65536) -> tuple:
+    """
+    Asigna cada píxel a su centroide más cercano de forma vectorizada
+    
+    Se procesa por bloques para que la matriz de distancias no crezca con la imagen.
+    
+    Args:
+        dataset: Píxeles normalizados (n_pixeles, canales)
+        centroides: Centroides (k, canales)
+        tamano_bloque: Número de píxeles por bloque
+        
+    Returns:
+        tuple: (etiquetas de cada píxel, distancia cuadrada a su centroide)
+    """
+    centroides = centroides.astype(np.float32)
+    norma_centroides = (centroides ** 2).sum(axis=1)
+    etiquetas = np.empty(dataset.shape[0], dtype=np.int32)
+    distancias = np.empty(dataset.shape[0], dtype=np.float32)
+    
+    for inicio in range(0, dataset.shape[0], tamano_bloque):
+        bloque = dataset[inicio:inicio + tamano_bloque]
+        d = norma_centroides - 2.0 * (bloque @ centroides.T)
+        etiquetas_bloque = d.argmin(axis=1)
+        etiquetas[inicio:inicio + tamano_bloque] = etiquetas_bloque
+        minimos = d[np.arange(bloque.shape[0]), etiquetas_bloque] + (bloque ** 2).sum(axis=1)
+        distancias[inicio:inicio + tamano_bloque] = np.maximum(minimos, 0)
+    
+    return etiquetas, distancias
+
+def asignar_imagen(imagen: np.ndarray, centroides: np.ndarray) -> np.ndarray:
+    """
+    Asigna cada píxel de la imagen a su centroide procesando franjas de filas
+    
+    Solo cada franja se convierte a float32, de modo que la memoria adicional
+    queda acotada por PIXELES_POR_FRANJA sea cual sea la resolución.
+    
+    Args:
+        imagen: Imagen BGR en uint8 (alto, ancho, 3)
+        centroides: Centroides BGR normalizados (k, 3), con k <= 256
+        
+    Returns:
+        np.ndarray: Mapa de etiquetas (alto, ancho) en uint8
+    """
+    alto, ancho = imagen.shape[:2]
+    etiquetas = np.empty((alto, ancho), dtype=np.uint8)
+    filas = max(1, PIXELES_POR_FRANJA // ancho)
+    for inicio in range(0, alto, filas):
+        franja = imagen[inicio:inicio + filas].reshape(-1, 3).astype(np.float32) / 255.0
+        etiquetas_franja, _ = asignar_centroides(franja, centroides)
+        etiquetas[inicio:inicio + filas] = etiquetas_franja.reshape(-1, ancho)
+    return etiquetas
+
+def ajustar_paleta(muestra: np.ndarray, k: int, centroides_previos: np.ndarray = None,
+                   opciones: OpcionesBarrido = None, pesos: np.ndarray = None) -> np.ndarray:
+    """
+    Ajusta la paleta de k colores, partiendo de la paleta de k-1 si se proporciona
+    
+    El centroide nuevo se ubica en el píxel más alejado del cluster con mayor error,
+    de modo que el ajuste solo tiene que refinar en lugar de empezar desde cero.
+    
+    Args:
+        muestra: Muestra de píxeles compartida por todo el barrido
+        k: Número de clusters
+        centroides_previos: Centroides obtenidos para k-1
+        opciones: Opciones del barrido con el perfil de ajuste
+        pesos: Peso de cada punto de la muestra (modo histograma)
+        
+    Returns:
+        np.ndarray: Centroides (k, canales)
+    """
+    opciones = opciones or OpcionesBarrido()
+    if centroides_previos is None:
+        modelo_cluster = crear_kmeans(k, opciones)
+    else:
+        etiquetas, distancias = asignar_centroides(muestra, centroides_previos)
+        error = distancias * pesos if pesos is not None else distancias
+        error_por_cluster = np.bincount(etiquetas, weights=error, minlength=len(centroides_previos))
+        peor_cluster = error_por_cluster.argmax()
+        candidatos = np.where(etiquetas == peor_cluster, distancias, -1.0)
+        nuevo_centroide = muestra[candidatos.argmax()]
+        
+        modelo_cluster = crear_kmeans(k, opciones, init=np.vstack([centroides_previos, nuevo_centroide]))
+    
+    with metricas.medir("imagen_ajuste_segundos", modo="incremental"):
+        return ajustar_kmeans(modelo_cluster, muestra, pesos)
+
+def ajustar_paleta_en_worker(muestra: np.ndarray, k: int, centroides_previos: np.ndarray,
+                             opciones: OpcionesBarrido, pesos: np.ndarray) -> dict:
+    """
+    Ajusta una paleta dentro del pool de imágenes y devuelve las métricas medidas
+
+    Returns:
+        dict: {"centroides": paleta ajustada, "metricas": observaciones capturadas}
+    """
+    with metricas.capturar() as capturadas:
+        centroides = ajustar_paleta(muestra, k, centroides_previos, opciones, pesos)
+    return {"centroides": centroides, "metricas": capturadas}
+
+def renderizar_paleta(args):
+    """
+    Genera la imagen cuantizada de una paleta ya calculada
+    
+    Args:
+        args: tupla (imagen, k, centroides, opciones)
+        
+    Returns:
+        dict: imagen procesada codificada
+    """
+    imagen, k, centroides, opciones = args
+    try:
+        with metricas.medir("imagen_asignacion_segundos"):
+            etiquetas = asignar_imagen(imagen, centroides)
+        return codificar_resultado(centroides, etiquetas, opciones)
+    except Exception as e:
+        logger.error(f"Error al renderizar k={k}: {str(e)}")
+        raise
+
+def preparar_imagen(image_array: np.ndarray, max_dimension: int = DIMENSION_MAXIMA) -> np.ndarray:
+    """
+    Ajusta la imagen BGR a la dimensión de trabajo
+    
+    La imagen se mantiene en uint8 y en BGR: las paletas se calculan en ese
+    orden y solo se convierten a RGB al devolverlas en el formato 'palette'.
+    
+    Args:
+        image_array: Array NumPy con la imagen en BGR
+        max_dimension: Lado mayor permitido; 0 conserva la resolución original
+        
+    Returns:
+        np.ndarray: Imagen BGR contigua en uint8
+    """
+    return np.ascontiguousarray(reducir_imagen(image_array, max_dimension))
+
+class ClavesBarrido:
+    """
+    Claves de caché de las paletas y de los fotogramas de un barrido
+    
+    Las paletas dependen de la imagen, la dimensión de trabajo, el modo y el
+    perfil de ajuste; los fotogramas además del formato y la calidad. Así un
+    cambio de formato reutiliza las paletas y solo vuelve a renderizar.
+    """
+    def __init__(self, img: np.ndarray, opciones: OpcionesBarrido):
+        huella = hashlib.sha256(np.ascontiguousarray(img))
+        huella.update(str(img.shape).encode("utf-8"))
+        self.base = {
+            "imagen": huella.hexdigest(),
+            "dimension": opciones.dimension,
+            "dimension_ajuste": DIMENSION_AJUSTE,
+            "incremental": opciones.incremental,
+            "ajuste": opciones.ajuste,
+            "version": 2
+        }
+        self.formato = opciones.formato
+        # La calidad solo afecta a los formatos con pérdida
+        self.calidad = opciones.calidad if opciones.formato in ("jpeg", "webp") else None
+
+    def paleta(self, k: int) -> str:
+        return clave_contenido(b"paleta", dict(self.base, k=k))
+
+    def fotograma(self, k: int) -> str:
+        return clave_contenido(b"fotograma", dict(self.base, k=k, formato=self.formato, calidad=self.calidad))
+
+# Caché de resultados de barridos: paletas y fotogramas codificados por k
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+image_cache = CacheNiveles(
+    CacheLRU(
+        max_entradas=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+    ),
+    CacheDisco(
+        IMAGE_CACHE_DIR,
+        max_bytes=int(os.getenv("IMAGE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+    ) if IMAGE_CACHE_DIR else None
+)
+
+class PixelesCompartidos:
+    """
+    Publica el array de píxeles en memoria compartida para los procesos del pool
+    
+    Los workers se conectan por nombre y leen el array sin que se serialice ni
+    se copie en cada tarea.
+    """
+    def __init__(self, dataset: np.ndarray):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(dataset.nbytes, 1))
+        destino = np.ndarray(dataset.shape, dtype=dataset.dtype, buffer=self.shm.buf)
+        destino[:] = dataset
+        del destino
+        self.ref = (self.shm.name, dataset.shape, dataset.dtype.str)
+
+    def liberar(self):
+        """Cierra y elimina el segmento de memoria compartida"""
+        self.shm.close()
+        self.shm.unlink()
+
+def ejecutar_con_pixeles(funcion, pixeles, args: tuple):
+    """
+    Ejecuta una unidad de trabajo del barrido dentro de un worker
+    
+    Args:
+        funcion: Función que recibe la tupla (dataset, *args)
+        pixeles: Array de píxeles o referencia (nombre, forma, dtype) a memoria compartida
+        args: Resto de argumentos de la función
+        
+    Returns:
+        Resultado de la función
+    """
+    if isinstance(pixeles, np.ndarray):
+        return funcion((pixeles,) + args)
+    
+    # En un proceso del pool las métricas se devuelven con el resultado
+    nombre, shape, dtype = pixeles
+    shm = shared_memory.SharedMemory(name=nombre)
+    dataset = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    try:
+        with metricas.capturar() as capturadas:
+            resultado = funcion((dataset,) + args)
+        resultado["metricas"] = capturadas
+        return resultado
+    finally:
+        del dataset
+        shm.close()
+
+# Rutas del sistema clasificador
+@app.post("/classifier/upload/")
+async def upload_classifier_file(
+    file: UploadFile = File(...),
+    training_mode: str = Form("auto")
+):
+    try:
+        contents = await leer_subida(file, "clasificador")
+        resolver_modo_entrenamiento(contents, training_mode)
+        
+        # Solo se leen los encabezados; el cuerpo se procesa al entrenar
+        preguntas = leer_encabezado(contents)[:-1]
+        
+        # La sesión guarda su propia copia para compartirla entre workers
+        session = await crear_sesion(contents, 'classifier')
+        session.modo_entrenamiento = training_mode
+        
+        await asyncio.to_thread(session_data.guardar, session)
+        
+        return {
+            "message": "Archivo cargado correctamente",
+            "session_id": session.id,
+            "questions": preguntas
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/classifier/predict/{session_id}")
+async def predict_classifier(session_id: str, respuestas: List[float]):
+    """
+    Endpoint para realizar predicciones usando los modelos entrenados
+    """
+    try:
+        session = await asyncio.to_thread(session_data.get, session_id)
+        if not session or session.session_type != 'classifier':
+            raise HTTPException(status_code=404, detail="Sesión no encontrada")
+        
+        modelos, accuracies, scaler = await asyncio.to_thread(obtener_modelos_sesion, session)
+        return formatear_prediccion(respuestas, modelos, accuracies, scaler)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/classifier/predict-batch/{session_id}")
+async def predict_classifier_batch(session_id: str, respuestas: List[List[float]]):
+    """
+    Endpoint para predecir un lote de casos con los modelos de la sesión
+
+    Args:
+        session_id: ID de la sesión del clasificador
+        respuestas: Matriz con una fila de respuestas por caso
+    """
+    try:
+        session = await asyncio.to_thread(session_data.get, session_id)
+        if not session or session.session_type != 'classifier':
+            raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+        if not respuestas:
+            raise HTTPException(status_code=400, detail="No se recibieron respuestas")
+
+        modelos, accuracies, scaler = await asyncio.to_thread(obtener_modelos_sesion, session)
+        return formatear_prediccion_lote(respuestas, modelos, accuracies, scaler)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/classifier/export/{session_id}")
+async def export_classifier_model(session_id: str):
+    """
+    Exporta el ensamble entrenado de una sesión como artefacto reutilizable
+
+    El identificador se deriva del contenido del archivo y de la configuración
+    de entrenamiento, así que exportar dos veces el mismo entrenamiento devuelve
+    el mismo modelo.
+
+    Args:
+        session_id: ID de la sesión del clasificador
+    Returns:
+        dict: Metadatos del modelo exportado
+    """
+    try:
+        session = await get_session(session_id, 'classifier')
+        return await asyncio.to_thread(exportar_modelo_sesion, session)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error al exportar el modelo: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/classifier/models/")
+async def list_classifier_models():
+    """
+    Lista los modelos exportados disponibles para crear sesiones de predicción
+    """
+    return {"models": almacen_modelos.listar()}
+
+@app.post("/classifier/models/{model_id}/session")
+async def load_classifier_model(model_id: str):
+    """
+    Crea una sesión de predicción a partir de un modelo exportado
+
+    Los modelos no se vuelven a entrenar: la sesión usa el artefacto mapeado en
+    memoria, por lo que los endpoints de predicción responden de inmediato.
+
+    Args:
+        model_id: ID del modelo exportado
+    Returns:
+        dict: ID de la nueva sesión y preguntas del modelo
+    """
+    metadatos = almacen_modelos.metadatos(model_id)
+    await asyncio.to_thread(almacen_modelos.cargar, model_id)
+
+    session = SessionData(b"", 'classifier')
+    session.modelo_id = model_id
+    session.modo_entrenamiento = metadatos.get("modo", "auto")
+    await asyncio.to_thread(session_data.guardar, session)
+
+    return {
+        "message": "Modelo cargado correctamente",
+        "session_id": session.id,
+        "model_id": model_id,
+        "questions": metadatos.get("preguntas", [])
+    }
+
+# Rutas del sistema experto
+@app.post("/expert-system/upload/")
+async def upload_expert_file(file: UploadFile = File(...)):
+    try:
+        contents = await leer_subida(file, "experto")
+        session = await crear_sesion(contents, 'expert')
+        
+        # La base de conocimiento se compila una sola vez al cargarla
+        session.tabla_decision = await asyncio.to_thread(obtener_modelo_experto, contents)
+        
+        await asyncio.to_thread(session_data.guardar, session)
+        
+        return {
+            "message": "Base de conocimiento cargada correctamente",
+            "session_id": session.id,
+            "questions": session.tabla_decision.preguntas
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/expert-system/get-questions/")
+async def get_questions(file: UploadFile = File(...)):
+    """Endpoint para obtener las preguntas del archivo"""
+    try:
+        contents = await leer_subida(file, "experto")
+        df = pd.read_excel(abrir_buffer(contents))
+        
         if df.empty:
             raise HTTPException(status_code=400, detail="El archivo está vacío")
             
@@ -402,6 +3124,8 @@ async def get_questions(file: UploadFile = File(...)):
         return {
             "questions": preguntas
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error al procesar archivo: {e}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -414,51 +3138,39 @@ async def predict_expert(
     """Endpoint para procesar respuestas y obtener predicción"""
     try:
         # Leer el archivo y las respuestas
-        contents = await file.read()
+        contents = await leer_subida(file, "experto")
         answers_array = json.loads(answers)
-        
-        # Validar el archivo
-        df = pd.read_excel(io.BytesIO(contents))
-        if df.empty:
-            raise HTTPException(status_code=400, detail="Error al cargar la base de conocimiento")
-
-        # Validar que el número de respuestas coincida con las columnas
-        if len(answers_array) != len(df.columns) - 1:
-            raise HTTPException(
-                status_code=400, 
-                detail="El número de respuestas no coincide con las preguntas del archivo"
-            )
+        
+        tabla = await asyncio.to_thread(obtener_modelo_experto, contents)
+        return formatear_decision_experto(tabla, answers_array)
+        
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error en predicción: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Preprocesar los datos
-        df_procesado = df.copy()
-        label_encoder = LabelEncoder()
-        df_procesado['Decisión'] = label_encoder.fit_transform(df['Decisión'])
+@app.post("/expert-system/predict/{session_id}")
+async def predict_expert_session(session_id: str, respuestas: List[float]):
+    """
+    Endpoint para predecir con la base de conocimiento compilada de una sesión
 
-        # Separar características y etiquetas
-        X = df_procesado.iloc[:, :-1]
-        y = df_procesado.iloc[:, -1]
+    Args:
+        session_id: ID de la sesión del sistema experto
+        respuestas: Una respuesta por pregunta
+    """
+    try:
+        session = await asyncio.to_thread(session_data.get, session_id)
+        if not session or session.session_type != 'expert':
+            raise HTTPException(status_code=404, detail="Sesión no encontrada")
 
-        # Entrenar y predecir
-        knn = KNeighborsClassifier(n_neighbors=3)
-        knn.fit(X, y)
-        
-        respuestas_array = np.array(answers_array).reshape(1, -1)
-        decision_codificada = knn.predict(respuestas_array)
-        decision = label_encoder.inverse_transform(decision_codificada)
+        if session.tabla_decision is None:
+            session.tabla_decision = await asyncio.to_thread(obtener_modelo_experto, session.contenido())
+            await asyncio.to_thread(session_data.guardar, session)
 
-        # Calcular confianza
-        probabilidades = knn.predict_proba(respuestas_array)[0]
-        max_prob = max(probabilidades)
-        nivel_confianza = "alta" if max_prob > 0.8 else "media" if max_prob > 0.6 else "baja"
-        
-        return {
-            "decision": decision[0],
-            "confianza": {
-                "nivel": nivel_confianza,
-                "valor": float(max_prob)
-            }
-        }
-        
+        return formatear_decision_experto(session.tabla_decision, respuestas)
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error en predicción: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -467,7 +3179,7 @@ async def predict_expert(
 @app.post("/upload-image/")
 async def upload_image(file: UploadFile = File(...)):
     try:
-        contents = await file.read()
+        contents = await leer_subida(file, "imagen")
         
         if not contents:
             raise HTTPException(status_code=400, detail="Archivo vacío")
@@ -478,11 +3190,10 @@ async def upload_image(file: UploadFile = File(...)):
         if img is None:
             raise HTTPException(status_code=400, detail="Formato de imagen no válido")
             
-        session = SessionData(contents, 'image')
+        session = await crear_sesion(contents, 'image')
         logger.info(f"Nueva sesión creada: {session.id}")
         
-        with session_lock:
-            session_data[session.id] = session
+        await asyncio.to_thread(session_data.guardar, session)
             
         return {
             "message": "Imagen cargada correctamente",
@@ -495,38 +3206,807 @@ async def upload_image(file: UploadFile = File(...)):
             raise e
         raise HTTPException(status_code=400, detail=str(e))
 
+def decodificar_imagen(image_data: bytes) -> np.ndarray:
+    """
+    Decodifica los bytes de una imagen a un array BGR
+    
+    Raises:
+        ValueError: Si el contenido no es una imagen válida
+    """
+    nparr = np.frombuffer(image_data, np.uint8)
+    with metricas.medir("imagen_decodificacion_segundos"):
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    
+    if img is None:
+        raise ValueError("No se pudo procesar la imagen")
+    return img
+
+# Formatos de respuesta soportados por /process-image/
+FORMATOS_SALIDA = ("json", "ndjson", "multipart", "zip")
+
+# Configuración del backend de procesamiento de imágenes
+IMAGE_BACKEND = os.getenv("IMAGE_BACKEND", "thread")
+IMAGE_MAX_WORKERS = int(os.getenv("IMAGE_MAX_WORKERS", str(min(os.cpu_count() or 1, 4))))
+IMAGE_MAX_CONCURRENT = int(os.getenv("IMAGE_MAX_CONCURRENT", "2"))
+IMAGE_MAX_QUEUE = int(os.getenv("IMAGE_MAX_QUEUE", "8"))
+# Límites de los lotes de /process-images/
+IMAGE_BATCH_CONCURRENCY = int(os.getenv("IMAGE_BATCH_CONCURRENCY", str(IMAGE_MAX_WORKERS)))
+IMAGE_BATCH_MAX_FILES = int(os.getenv("IMAGE_BATCH_MAX_FILES", "100"))
+IMAGE_BATCH_MAX_BYTES = LIMITES_SUBIDA["lote"]
+
 class ImageProcessor:
-    def __init__(self):
-        self.processing_lock = asyncio.Lock()
+    """
+    Ejecuta los barridos de K-means fuera del event loop en un pool compartido
+    
+    El pool puede ser de hilos o de procesos ('thread' | 'process'). Con procesos
+    los píxeles se entregan a los workers por memoria compartida. El número de
+    barridos simultáneos está acotado y las peticiones que exceden la cola se
+    rechazan con 429.
+    """
+    def __init__(
+        self,
+        backend: str = IMAGE_BACKEND,
+        max_workers: int = IMAGE_MAX_WORKERS,
+        max_concurrent: int = IMAGE_MAX_CONCURRENT,
+        max_queue: int = IMAGE_MAX_QUEUE
+    ):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Backend de imágenes no soportado: {backend}")
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.processing_lock = asyncio.Semaphore(max_concurrent)
+        self.en_cola = 0
+        self._executor = None
 
-    async def process_image(self, image_data: bytes, steps: int) -> dict:
+    @property
+    def executor(self):
+        """Pool de workers, creado en el primer uso"""
+        if self._executor is None:
+            if self.backend == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            logger.info(f"Pool de imágenes '{self.backend}' iniciado con {self.max_workers} workers")
+        return self._executor
+
+    def shutdown(self):
+        """Detiene el pool de workers"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def verificar_capacidad(self):
+        """
+        Rechaza la petición si la cola de espera está llena
+        
+        Raises:
+            HTTPException: 429 si hay demasiadas imágenes esperando turno
+        """
+        if self.en_cola >= self.max_queue:
+            metricas.incrementar("imagen_rechazos_total")
+            raise HTTPException(
+                status_code=429,
+                detail="Demasiadas imágenes en cola, intente de nuevo más tarde"
+            )
+
+    @asynccontextmanager
+    async def turno(self):
+        """Espera un turno de procesamiento respetando el límite de la cola"""
+        self.verificar_capacidad()
+        self.en_cola += 1
+        inicio = time.perf_counter()
+        try:
+            await self.processing_lock.acquire()
+        finally:
+            self.en_cola -= 1
+            metricas.observar("imagen_espera_turno_segundos", time.perf_counter() - inicio)
+        try:
+            yield
+        finally:
+            self.processing_lock.release()
+
+    async def process_image(self, image_data: bytes, steps: int, opciones: OpcionesBarrido = None) -> dict:
         """Procesa una imagen sin depender de sesiones"""
-        async with self.processing_lock:
+        opciones = opciones or OpcionesBarrido()
+        self.verificar_capacidad()
+        try:
+            loop = asyncio.get_running_loop()
+            img = await loop.run_in_executor(None, decodificar_imagen, image_data)
+            
+            resultados = {}
+            async for resultado in self.stream_image(img, steps, opciones):
+                resultados[resultado["k"]] = serializar_resultado(resultado, opciones.formato)
+            
+            respuesta = {
+                "images": [resultados[k]["image"] for k in sorted(resultados)],
+                "status": "success"
+            }
+            if opciones.formato == "palette":
+                respuesta["palettes"] = [resultados[k]["palette"] for k in sorted(resultados)]
+            return respuesta
+            
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Error procesando imagen: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+    async def stream_image(self, img: np.ndarray, steps: int, opciones: OpcionesBarrido = None):
+        """
+        Procesa una imagen y entrega cada resultado en cuanto termina su k
+        
+        Los k cuyo fotograma ya está en la caché se entregan primero, sin esperar
+        turno; el resto se calcula con _barrido.
+        
+        Args:
+            img: Imagen decodificada en BGR
+            steps: Número máximo de clusters
+            opciones: Opciones del barrido
+            
+        Yields:
+            dict: {"k": k, "image": bytes de la imagen codificada} por cada k procesado,
+                más "palette" en el formato 'palette'
+        """
+        opciones = opciones or OpcionesBarrido()
+        claves = await asyncio.get_running_loop().run_in_executor(None, ClavesBarrido, img, opciones)
+        
+        faltantes = []
+        for k in range(2, steps + 1):
+            resultado = await image_cache.aget(claves.fotograma(k))
+            if resultado is None:
+                faltantes.append(k)
+            else:
+                yield {"k": k, **resultado}
+        if not faltantes:
+            return
+        
+        async with self.turno():
+            async for resultado in self._barrido(img, claves, faltantes, opciones):
+                yield resultado
+
+    async def stream_batch(self, archivos: List[tuple], steps: int, opciones: OpcionesBarrido = None):
+        """
+        Procesa un lote de imágenes ocupando un único turno
+        
+        Las imágenes se decodifican y barren de forma concurrente (hasta
+        IMAGE_BATCH_CONCURRENCY a la vez) y todas sus unidades (imagen, k)
+        comparten el pool de workers y un único cupo de max_workers unidades
+        en vuelo para todo el lote. Los archivos con el mismo contenido se
+        procesan una sola vez.
+        
+        Args:
+            archivos: Lista de (nombre, bytes) de cada imagen
+            steps: Número máximo de clusters
+            opciones: Opciones del barrido
+            
+        Yields:
+            dict: {"index", "file", "k", "image"[, "palette"]} por cada resultado,
+                {"index", "file", "status": "success", "total"} al terminar cada
+                imagen o {"index", "file", "status": "error", "detail"} si falla
+        """
+        opciones = opciones or OpcionesBarrido()
+        loop = asyncio.get_running_loop()
+        
+        # Agrupa los archivos idénticos para decodificarlos y barrerlos una vez
+        grupos = OrderedDict()
+        for indice, (_, contenido) in enumerate(archivos):
+            grupos.setdefault(hashlib.sha256(contenido).digest(), []).append(indice)
+        
+        async with self.turno():
+            salida = asyncio.Queue(maxsize=2 * self.max_workers)
+            limite = asyncio.Semaphore(IMAGE_BATCH_CONCURRENCY)
+            vuelo = asyncio.Semaphore(self.max_workers)
+            
+            async def procesar(indices: list):
+                total = 0
+                try:
+                    async with limite:
+                        img = await loop.run_in_executor(None, decodificar_imagen, archivos[indices[0]][1])
+                        claves = await loop.run_in_executor(None, ClavesBarrido, img, opciones)
+                        faltantes = []
+                        for k in range(2, steps + 1):
+                            resultado = await image_cache.aget(claves.fotograma(k))
+                            if resultado is None:
+                                faltantes.append(k)
+                            else:
+                                total += 1
+                                await salida.put((indices, {"k": k, **resultado}))
+                        if faltantes:
+                            async for resultado in self._barrido(img, claves, faltantes, opciones, vuelo):
+                                total += 1
+                                await salida.put((indices, resultado))
+                    await salida.put((indices, {"status": "success", "total": total}))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error procesando {archivos[indices[0]][0]} del lote: {e}")
+                    await salida.put((indices, {"status": "error", "detail": str(e)}))
+            
+            tareas = [asyncio.create_task(procesar(indices)) for indices in grupos.values()]
             try:
-                nparr = np.frombuffer(image_data, np.uint8)
-                img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                
-                if img is None:
-                    raise ValueError("No se pudo procesar la imagen")
-                
-                processed_images = process_image_with_kmeans(img, steps)
-                
-                return {
-                    "images": processed_images,
-                    "status": "success"
-                }
-                
-            except Exception as e:
-                logger.error(f"Error procesando imagen: {e}")
-                raise HTTPException(status_code=500, detail=str(e))
+                restantes = len(tareas)
+                while restantes:
+                    indices, resultado = await salida.get()
+                    if "status" in resultado:
+                        restantes -= 1
+                    for indice in indices:
+                        yield {"index": indice, "file": archivos[indice][0], **resultado}
+            finally:
+                # Si el cliente se desconecta se cancelan las imágenes pendientes
+                for tarea in tareas:
+                    tarea.cancel()
+                await asyncio.gather(*tareas, return_exceptions=True)
+
+    async def _barrido(
+        self,
+        img: np.ndarray,
+        claves: ClavesBarrido,
+        faltantes: List[int],
+        opciones: OpcionesBarrido,
+        vuelo: asyncio.Semaphore = None
+    ):
+        """
+        Calcula los k indicados de una imagen en el pool de workers
+        
+        Los k que tienen la paleta en caché solo se renderizan; en el barrido
+        incremental las paletas que faltan se ajustan partiendo de la mayor
+        paleta anterior disponible.
+        
+        Cada k es una unidad de trabajo independiente en el pool. Solo se mantienen
+        en vuelo tantos valores de k como workers, de modo que la memoria queda
+        acotada a unas pocas imágenes codificadas.
+        
+        Args:
+            vuelo: Cupo de unidades en vuelo compartido entre varios barridos
+                (un lote); si no se indica, el barrido usa uno propio
+        
+        Yields:
+            dict: {"k": k, "image": bytes de la imagen codificada}, más "palette"
+                en el formato 'palette'
+        """
+        incremental = opciones.incremental
+        loop = asyncio.get_running_loop()
+        imagen = await loop.run_in_executor(None, preparar_imagen, img, opciones.dimension)
+        compartidos = PixelesCompartidos(imagen) if self.backend == "process" else None
+        pixeles = compartidos.ref if compartidos else imagen
+        vuelo = vuelo or asyncio.Semaphore(self.max_workers)
+        en_vuelo = {}
+        
+        try:
+            muestra = pesos = None
+            # Última paleta conocida de la cadena incremental y su k
+            centroides, k_centroides = None, 1
+            pendientes_k = deque(faltantes)
+            
+            async def paleta_incremental(k: int) -> np.ndarray:
+                """Avanza la cadena de paletas hasta k usando la caché donde se pueda"""
+                nonlocal muestra, pesos, centroides, k_centroides
+                while k_centroides < k:
+                    siguiente = k_centroides + 1
+                    paleta = await image_cache.aget(claves.paleta(siguiente))
+                    if paleta is None:
+                        if muestra is None:
+                            muestra, pesos = await loop.run_in_executor(None, muestra_de_ajuste, imagen, opciones)
+                        resultado = await loop.run_in_executor(
+                            self.executor, ajustar_paleta_en_worker, muestra, siguiente, centroides, opciones, pesos
+                        )
+                        metricas.fusionar(resultado["metricas"])
+                        paleta = resultado["centroides"]
+                        await image_cache.aput(claves.paleta(siguiente), paleta, paleta.nbytes)
+                    centroides, k_centroides = paleta, siguiente
+                return centroides
+            
+            async def lanzar(k: int):
+                # El cupo cubre también el ajuste incremental, que ocupa un worker
+                await vuelo.acquire()
+                try:
+                    if incremental:
+                        # Las paletas dependen de la anterior y se calculan en orden
+                        # sobre la muestra; la asignación y codificación van al pool
+                        paleta = await paleta_incremental(k)
+                    else:
+                        paleta = await image_cache.aget(claves.paleta(k))
+                    if paleta is not None:
+                        funcion, args = renderizar_paleta, (k, paleta, opciones)
+                    else:
+                        funcion, args = process_single_kmeans, (k, opciones)
+                    futuro = loop.run_in_executor(self.executor, ejecutar_con_pixeles, funcion, pixeles, args)
+                except BaseException:
+                    vuelo.release()
+                    raise
+                en_vuelo[futuro] = k
+            
+            async def llenar():
+                """
+                Lanza k pendientes mientras quede cupo. Solo se espera a que se
+                libere cupo si este barrido no tiene nada en vuelo: esperar con
+                unidades propias pendientes de recoger bloquearía a los demás
+                barridos del lote que comparten el cupo.
+                """
+                while pendientes_k and len(en_vuelo) < self.max_workers and not (en_vuelo and vuelo.locked()):
+                    await lanzar(pendientes_k.popleft())
+            
+            await llenar()
+            while en_vuelo:
+                terminados, _ = await asyncio.wait(en_vuelo, return_when=asyncio.FIRST_COMPLETED)
+                listos = []
+                for futuro in terminados:
+                    k = en_vuelo.pop(futuro)
+                    vuelo.release()
+                    resultado = futuro.result()
+                    metricas.fusionar(resultado.pop("metricas", []))
+                    paleta = resultado.pop("centroides", None)
+                    if paleta is not None:
+                        await image_cache.aput(claves.paleta(k), paleta, paleta.nbytes)
+                    await image_cache.aput(claves.fotograma(k), resultado, len(resultado["image"]))
+                    listos.append({"k": k, **resultado})
+                await llenar()
+                for resultado in listos:
+                    yield resultado
+        finally:
+            # Si el cliente se desconecta no se espera a los k pendientes
+            for futuro in en_vuelo:
+                futuro.cancel()
+                vuelo.release()
+            if compartidos is not None:
+                compartidos.liberar()
 
 # Instancia global del procesador
 image_processor = ImageProcessor()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Detiene los pools de procesamiento de imágenes y de entrenamiento"""
+    image_processor.shutdown()
+    training_executor.shutdown(wait=False, cancel_futures=True)
+    session_data.volcar_accesos()
+
+def tasa_aciertos(cache: CacheLRU) -> float:
+    """Proporción de consultas a la caché que encontraron la entrada"""
+    consultas = cache.aciertos + cache.fallos
+    return cache.aciertos / consultas if consultas else 0.0
+
+metricas.registrar_indicador("sesiones", "Sesiones almacenadas", lambda: len(session_data))
+metricas.registrar_indicador("sesiones_en_memoria", "Sesiones en la caché de memoria", lambda: len(session_data._memoria))
+metricas.registrar_indicador("sesiones_memoria_bytes", "Bytes de las sesiones en memoria", lambda: session_data.bytes_en_memoria)
+metricas.registrar_indicador("imagen_en_cola", "Barridos esperando turno", lambda: image_processor.en_cola)
+metricas.registrar_indicador("trabajos_imagen", "Trabajos de imágenes registrados", lambda: len(almacen_trabajos))
+metricas.registrar_indicador("trabajos_imagen_en_ejecucion", "Trabajos de imágenes en ejecución en este worker", lambda: len(image_jobs))
+metricas.registrar_indicador(
+    "clasificador_entrenamientos_abandonados", "Modelos descartados por tiempo que siguen ocupando un worker de entrenamiento",
+    lambda: entrenamientos_abandonados
+)
+metricas.registrar_indicador("cache_modelos_degradados_entradas", "Ensambles con modelos descartados en uso temporal", lambda: len(ensambles_degradados))
+metricas.registrar_indicador("cache_modelos_entradas", "Entradas en la caché de modelos", lambda: len(model_cache))
+metricas.registrar_indicador("cache_modelos_bytes", "Bytes en la caché de modelos", lambda: model_cache.bytes_usados)
+metricas.registrar_indicador("cache_modelos_aciertos", "Aciertos de la caché de modelos", lambda: model_cache.aciertos)
+metricas.registrar_indicador("cache_modelos_fallos", "Fallos de la caché de modelos", lambda: model_cache.fallos)
+metricas.registrar_indicador("cache_modelos_tasa_aciertos", "Tasa de aciertos de la caché de modelos", lambda: tasa_aciertos(model_cache))
+metricas.registrar_indicador(
+    "importacion_segundos", "Segundos dedicados a importar dependencias diferidas",
+    lambda: sum(modulo["segundos"] or 0.0 for modulo in importaciones.informe()["modulos"])
+)
+metricas.registrar_indicador("modelos_cargados", "Modelos exportados cargados en memoria", lambda: len(almacen_modelos._cargados))
+metricas.registrar_indicador("cache_imagenes_entradas", "Entradas en la caché de imágenes en memoria", lambda: len(image_cache.memoria))
+metricas.registrar_indicador("cache_imagenes_bytes", "Bytes en la caché de imágenes en memoria", lambda: image_cache.memoria.bytes_usados)
+metricas.registrar_indicador("cache_imagenes_tasa_aciertos", "Tasa de aciertos de la caché de imágenes en memoria", lambda: tasa_aciertos(image_cache.memoria))
+metricas.registrar_indicador(
+    "cache_imagenes_disco_bytes", "Bytes en la caché de imágenes en disco",
+    lambda: image_cache.disco.bytes_usados if image_cache.disco else 0
+)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Endpoint con las métricas internas en formato de texto de Prometheus"""
+    # Algunos indicadores consultan el almacén de sesiones
+    return PlainTextResponse(await asyncio.to_thread(metricas.exportar), media_type="text/plain; version=0.0.4")
+
+@app.get("/startup/imports")
+async def get_startup_imports():
+    """
+    Informe del arranque: modo de importación, tiempo hasta aceptar peticiones
+    y coste de importar las dependencias de cada subsistema
+    """
+    return importaciones.informe()
+
+class AlmacenTrabajos:
+    """
+    Estado y resultados de los trabajos de imágenes en SQLite
+    
+    Usa el mismo archivo que el almacén de sesiones, así que cualquier worker
+    puede consultar el progreso y los resultados de un trabajo que se ejecuta en
+    otro. Cada resultado se escribe en cuanto termina y se lee bajo demanda, de
+    modo que las imágenes no permanecen en memoria hasta que el cliente las pide.
+    
+    Cada trabajo registra el worker que lo ejecuta, que renueva periódicamente
+    su latido con `latir`. Los trabajos sin terminar cuyo latido caduca (el
+    worker se detuvo o reinició) se marcan como error con `marcar_abandonados`.
+    """
+    def __init__(self, ruta: str, propietario: str, caducidad_latido: float):
+        self.propietario = propietario
+        self.caducidad_latido = caducidad_latido
+        self._lock = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS trabajos (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                formato TEXT NOT NULL,
+                error TEXT,
+                creado REAL NOT NULL,
+                terminado REAL,
+                propietario TEXT,
+                latido REAL
+            );
+            CREATE INDEX IF NOT EXISTS trabajos_sesion ON trabajos (session_id);
+            CREATE TABLE IF NOT EXISTS resultados_trabajo (
+                trabajo_id TEXT NOT NULL,
+                indice INTEGER NOT NULL,
+                k INTEGER NOT NULL,
+                datos BLOB NOT NULL,
+                PRIMARY KEY (trabajo_id, indice)
+            );
+            """
+        )
+        # Las tablas creadas antes de registrar el propietario no tienen sus columnas
+        columnas = {fila[1] for fila in self._conexion.execute("PRAGMA table_info(trabajos)")}
+        for columna, tipo in (("propietario", "TEXT"), ("latido", "REAL")):
+            if columna not in columnas:
+                self._conexion.execute(f"ALTER TABLE trabajos ADD COLUMN {columna} {tipo}")
+        self._conexion.commit()
+
+    def latir(self):
+        """Renueva el latido de los trabajos sin terminar de este worker"""
+        with self._lock:
+            self._conexion.execute(
+                "UPDATE trabajos SET latido = ? WHERE propietario = ? AND estado IN ('pendiente', 'procesando')",
+                (time.time(), self.propietario)
+            )
+            self._conexion.commit()
+
+    def marcar_abandonados(self, session_id: str = None) -> List[str]:
+        """
+        Marca como error los trabajos sin terminar cuyo worker dejó de renovar el latido
+        
+        Args:
+            session_id: Limita la revisión a los trabajos de una sesión
+        Returns:
+            List[str]: IDs de los trabajos marcados
+        """
+        condicion = "estado IN ('pendiente', 'procesando') AND (latido IS NULL OR latido < ?)"
+        parametros = [time.time() - self.caducidad_latido]
+        if session_id is not None:
+            condicion += " AND session_id = ?"
+            parametros.append(session_id)
+        with self._lock:
+            abandonados = [
+                fila[0] for fila in self._conexion.execute(f"SELECT id FROM trabajos WHERE {condicion}", parametros)
+            ]
+            if abandonados:
+                self._conexion.execute(
+                    f"UPDATE trabajos SET estado = 'error', error = ?, terminado = ? WHERE {condicion}",
+                    ["El worker que ejecutaba el trabajo se detuvo", time.time(), *parametros]
+                )
+                self._conexion.commit()
+        return abandonados
+
+    def crear(self, trabajo: "TrabajoImagen") -> bool:
+        """
+        Registra un trabajo si su sesión no tiene otro en curso en ningún worker
+        
+        Returns:
+            bool: False si la sesión ya tenía un trabajo pendiente o en proceso
+        """
+        # Un trabajo de un worker caído no bloquea la sesión
+        self.marcar_abandonados(trabajo.session_id)
+        with self._lock:
+            cursor = self._conexion.execute(
+                "INSERT INTO trabajos (id, session_id, estado, total, formato, creado, propietario, latido) "
+                "SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS ("
+                "SELECT 1 FROM trabajos WHERE session_id = ? AND estado IN ('pendiente', 'procesando'))",
+                (trabajo.id, trabajo.session_id, trabajo.estado, trabajo.total, trabajo.opciones.formato,
+                 trabajo.creado.timestamp(), self.propietario, time.time(), trabajo.session_id)
+            )
+            self._conexion.commit()
+            return cursor.rowcount == 1
+
+    def actualizar(self, trabajo: "TrabajoImagen", terminado: bool = False):
+        """Persiste el estado del trabajo y, si terminó, el momento en que lo hizo"""
+        with self._lock:
+            self._conexion.execute(
+                "UPDATE trabajos SET estado = ?, error = ?, terminado = ? WHERE id = ?",
+                (trabajo.estado, trabajo.error, time.time() if terminado else None, trabajo.id)
+            )
+            self._conexion.commit()
+
+    def agregar_resultado(self, trabajo: "TrabajoImagen", indice: int, resultado: dict) -> bool:
+        """
+        Guarda un resultado del barrido
+        
+        Returns:
+            bool: Si la sesión del trabajo sigue activa; en otro caso el barrido debe detenerse
+        """
+        datos = pickle.dumps(resultado, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO resultados_trabajo (trabajo_id, indice, k, datos) VALUES (?, ?, ?, ?)",
+                (trabajo.id, indice, resultado["k"], sqlite3.Binary(datos))
+            )
+            self._conexion.commit()
+            fila = self._conexion.execute(
+                "SELECT activa FROM sesiones WHERE id = ?", (trabajo.session_id,)
+            ).fetchone()
+        return bool(fila and fila[0])
+
+    def obtener(self, trabajo_id: str):
+        """
+        Obtiene el estado de un trabajo
+        
+        Returns:
+            dict: Resumen del trabajo, su formato y si la sesión sigue existiendo, o None
+        """
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT session_id, estado, total, formato, error, "
+                "(SELECT COUNT(*) FROM resultados_trabajo WHERE trabajo_id = trabajos.id), "
+                "EXISTS (SELECT 1 FROM sesiones WHERE sesiones.id = trabajos.session_id) "
+                "FROM trabajos WHERE id = ?",
+                (trabajo_id,)
+            ).fetchone()
+        if fila is None:
+            return None
+        session_id, estado, total, formato, error, completados, sesion = fila
+        return {
+            "job_id": trabajo_id,
+            "session_id": session_id,
+            "status": estado,
+            "completados": completados,
+            "total": total,
+            "progreso": completados / total,
+            "error": error,
+            "formato": formato,
+            "sesion": bool(sesion)
+        }
+
+    def resultados(self, trabajo_id: str, desde: int = 0, imagenes: bool = True) -> List[dict]:
+        """Resultados a partir del índice `desde`; sin `imagenes` solo se leen los valores de k"""
+        with self._lock:
+            if not imagenes:
+                return [
+                    {"k": fila[0]} for fila in self._conexion.execute(
+                        "SELECT k FROM resultados_trabajo WHERE trabajo_id = ? AND indice >= ? ORDER BY indice",
+                        (trabajo_id, desde)
+                    )
+                ]
+            filas = self._conexion.execute(
+                "SELECT datos FROM resultados_trabajo WHERE trabajo_id = ? AND indice >= ? ORDER BY indice",
+                (trabajo_id, desde)
+            ).fetchall()
+        return [pickle.loads(fila[0]) for fila in filas]
+
+    def resultado(self, trabajo_id: str, k: int):
+        """Resultado de un k del trabajo, o None si aún no está disponible"""
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT datos FROM resultados_trabajo WHERE trabajo_id = ? AND k = ?",
+                (trabajo_id, k)
+            ).fetchone()
+        return pickle.loads(fila[0]) if fila else None
+
+    def eliminar_huerfanos(self) -> List[str]:
+        """
+        Elimina los trabajos cuya sesión ya no existe junto con sus resultados
+        
+        Returns:
+            List[str]: IDs de los trabajos eliminados
+        """
+        condicion = "session_id NOT IN (SELECT id FROM sesiones)"
+        with self._lock:
+            eliminados = [
+                fila[0] for fila in self._conexion.execute(f"SELECT id FROM trabajos WHERE {condicion}")
+            ]
+            self._conexion.execute(f"DELETE FROM trabajos WHERE {condicion}")
+            self._conexion.execute(
+                "DELETE FROM resultados_trabajo WHERE trabajo_id NOT IN (SELECT id FROM trabajos)"
+            )
+            self._conexion.commit()
+        return eliminados
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conexion.execute("SELECT COUNT(*) FROM trabajos").fetchone()[0]
+
+# Segundos entre latidos de los trabajos en ejecución; tras tres latidos perdidos se dan por abandonados
+IMAGE_JOB_HEARTBEAT_SECONDS = float(os.getenv("IMAGE_JOB_HEARTBEAT_SECONDS", "10"))
+almacen_trabajos = AlmacenTrabajos(
+    session_data.ruta,
+    propietario=f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}",
+    caducidad_latido=3 * IMAGE_JOB_HEARTBEAT_SECONDS
+)
+
+class TrabajoImagen:
+    """
+    Trabajo en segundo plano que procesa la imagen de una sesión
+    
+    El objeto solo existe en el worker que ejecuta el barrido; el estado y los
+    resultados se guardan en `almacen_trabajos` a medida que terminan, de modo
+    que se pueden consultar desde cualquier worker antes de que acabe.
+    """
+    def __init__(self, session_id: str, steps: int, opciones: OpcionesBarrido):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.steps = steps
+        self.opciones = opciones
+        self.estado = "pendiente"
+        self.error = None
+        self.creado = datetime.now()
+        self.tarea = None
+
+    @property
+    def total(self) -> int:
+        """Número de valores de k del barrido"""
+        return self.steps - 1
+
+    def cancelar(self):
+        """Cancela la tarea si sigue en ejecución"""
+        if self.tarea and not self.tarea.done():
+            self.tarea.cancel()
+
+async def ejecutar_trabajo(trabajo: TrabajoImagen, datos: bytes):
+    """
+    Ejecuta el barrido de una imagen guardando cada resultado en cuanto termina
+    
+    Se detiene si la sesión se limpia con /cleanup-session/ desde cualquier worker.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        img = await loop.run_in_executor(None, decodificar_imagen, datos)
+        del datos
+        trabajo.estado = "procesando"
+        await asyncio.to_thread(almacen_trabajos.actualizar, trabajo)
+        
+        indice = 0
+        async for resultado in image_processor.stream_image(img, trabajo.steps, trabajo.opciones):
+            activa = await asyncio.to_thread(almacen_trabajos.agregar_resultado, trabajo, indice, resultado)
+            indice += 1
+            if not activa:
+                trabajo.estado = "cancelado"
+                break
+        else:
+            trabajo.estado = "completado"
+    except asyncio.CancelledError:
+        trabajo.estado = "cancelado"
+    except Exception as e:
+        logger.error(f"Error en trabajo {trabajo.id}: {e}")
+        trabajo.estado = "error"
+        trabajo.error = e.detail if isinstance(e, HTTPException) else str(e)
+    finally:
+        image_jobs.pop(trabajo.id, None)
+        await asyncio.to_thread(almacen_trabajos.actualizar, trabajo, True)
+        logger.info(f"Trabajo {trabajo.id} finalizado con estado {trabajo.estado}")
+
+async def generar_ndjson(img: np.ndarray, steps: int, opciones: OpcionesBarrido):
+    """Serializa los resultados del procesamiento como líneas NDJSON"""
+    total = 0
+    try:
+        async for resultado in image_processor.stream_image(img, steps, opciones):
+            total += 1
+            yield json.dumps(serializar_resultado(resultado, opciones.formato)) + "\n"
+        yield json.dumps({"status": "success", "total": total}) + "\n"
+    except Exception as e:
+        logger.error(f"Error procesando imagen en streaming: {e}")
+        yield json.dumps({"status": "error", "detail": str(e)}) + "\n"
+
+def nombre_archivo_k(k: int, formato: str) -> str:
+    """Nombre de archivo de la imagen de un k"""
+    return f"k_{k:03d}{FORMATOS_IMAGEN[formato]['extension']}"
+
+async def generar_multipart(img: np.ndarray, steps: int, opciones: OpcionesBarrido, boundary: str):
+    """
+    Envía cada imagen como una parte binaria de un multipart/mixed
+    
+    Si el barrido falla se añade una parte JSON con el error antes del
+    delimitador de cierre, igual que la última línea del NDJSON.
+    """
+    media_type = FORMATOS_IMAGEN[opciones.formato]["media_type"]
+    try:
+        async for resultado in image_processor.stream_image(img, steps, opciones):
+            k = resultado["k"]
+            cabecera = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Disposition: attachment; filename=\"{nombre_archivo_k(k, opciones.formato)}\"\r\n"
+                f"X-K: {k}\r\n\r\n"
+            )
+            yield cabecera.encode('utf-8') + resultado["image"] + b"\r\n"
+    except Exception as e:
+        logger.error(f"Error procesando imagen en multipart: {e}")
+        cabecera = (
+            f"--{boundary}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Disposition: attachment; filename=\"error.json\"\r\n\r\n"
+        )
+        yield cabecera.encode('utf-8') + json.dumps({"status": "error", "detail": str(e)}).encode('utf-8') + b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+class SalidaZip(io.RawIOBase):
+    """Buffer no posicionable donde zipfile escribe y del que se vacían los bytes al stream"""
+    def __init__(self):
+        self.partes = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self.partes)
+        self.partes.clear()
+        return datos
+
+async def generar_zip(img: np.ndarray, steps: int, opciones: OpcionesBarrido):
+    """
+    Envía las imágenes como un archivo zip que se escribe a medida que terminan
+    
+    Si el barrido falla se añade una entrada error.json y el directorio central
+    se escribe igualmente, de modo que el zip recibido siempre es válido.
+    """
+    salida = SalidaZip()
+    # Las imágenes ya están comprimidas, se guardan sin recomprimir
+    with zipfile.ZipFile(salida, mode="w", compression=zipfile.ZIP_STORED) as archivo_zip:
+        try:
+            async for resultado in image_processor.stream_image(img, steps, opciones):
+                archivo_zip.writestr(nombre_archivo_k(resultado["k"], opciones.formato), resultado["image"])
+                yield salida.vaciar()
+        except Exception as e:
+            logger.error(f"Error procesando imagen en zip: {e}")
+            archivo_zip.writestr("error.json", json.dumps({"status": "error", "detail": str(e)}))
+    yield salida.vaciar()
+
+def opciones_barrido(
+    incremental: bool = Query(True, description="Reutiliza la paleta de k-1 como punto de partida para k"),
+    image_format: str = Query("jpeg", description="Formato de las imágenes: jpeg, webp, png o palette (PNG indexado con su paleta)"),
+    quality: int = Query(85, description="Calidad de compresión para jpeg y webp", ge=1, le=100),
+    fit_quality: str = Query("balanced", description="Perfil de ajuste de K-means: fast (histograma de colores), balanced (muestra de píxeles) o exact (todos los píxeles)"),
+    max_dimension: int = Query(DIMENSION_MAXIMA, description="Lado mayor de la imagen procesada; 0 conserva la resolución original", ge=0)
+) -> OpcionesBarrido:
+    """
+    Dependencia que construye las opciones del barrido a partir de la consulta
+    
+    Args:
+        incremental: Si es False, cada k se ajusta desde cero
+        image_format: Formato de las imágenes generadas; 'palette' devuelve PNG indexados
+            sin pérdida junto con la paleta de cada k para recolorear en el cliente
+        quality: Calidad de compresión
+        fit_quality: 'fast' ajusta sobre el histograma de colores con parada temprana
+            agresiva, 'balanced' sobre una muestra de píxeles y 'exact' sobre todos
+        max_dimension: Lado mayor de la salida; con 0 se genera a resolución completa
+            ajustando la paleta sobre una versión reducida
+        
+    Raises:
+        HTTPException: Si alguna opción no es válida
+    """
+    try:
+        return OpcionesBarrido(incremental, image_format, quality, fit_quality, max_dimension)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/process-image/")
 async def process_image(
     file: UploadFile = File(...),
-    steps: int = Query(..., description="Número de clusters para K-means", ge=2, le=100)
+    steps: int = Query(..., description="Número de clusters para K-means", ge=2, le=100),
+    output: str = Query("json", description="Formato de respuesta: json, ndjson, multipart o zip"),
+    opciones: OpcionesBarrido = Depends(opciones_barrido)
 ):
     """
     Endpoint para procesar una imagen usando K-means
@@ -534,16 +4014,43 @@ async def process_image(
     Args:
         file: Archivo de imagen a procesar
         steps: Número de clusters a usar
+        output: 'json' devuelve todas las imágenes al final en base64, 'ndjson' las envía
+            en base64 a medida que terminan; 'multipart' y 'zip' las envían en binario
+        opciones: Opciones del barrido construidas por opciones_barrido
         
     Returns:
         dict: Resultado del procesamiento con las imágenes generadas
     """
     try:
-        contents = await file.read()
+        if output not in FORMATOS_SALIDA:
+            raise HTTPException(status_code=400, detail=f"Formato de salida no soportado: {output}")
+        
+        contents = await leer_subida(file, "imagen")
         if not contents:
             raise HTTPException(status_code=400, detail="Archivo vacío")
+        
+        if output != "json":
+            image_processor.verificar_capacidad()
+            try:
+                img = await asyncio.get_running_loop().run_in_executor(None, decodificar_imagen, contents)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            if output == "ndjson":
+                return StreamingResponse(generar_ndjson(img, steps, opciones), media_type="application/x-ndjson")
+            if output == "multipart":
+                boundary = uuid.uuid4().hex
+                return StreamingResponse(
+                    generar_multipart(img, steps, opciones, boundary),
+                    media_type=f"multipart/mixed; boundary={boundary}"
+                )
+            return StreamingResponse(
+                generar_zip(img, steps, opciones),
+                media_type="application/zip",
+                headers={"Content-Disposition": "attachment; filename=\"kmeans.zip\""}
+            )
             
-        result = await image_processor.process_image(contents, steps)
+        result = await image_processor.process_image(contents, steps, opciones)
         return result
         
     except Exception as e:
@@ -552,62 +4059,294 @@ async def process_image(
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+# Extensiones de imagen que se toman de un zip del lote
+EXTENSIONES_LOTE = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+async def leer_archivos_lote(files: List[UploadFile], archive: UploadFile) -> List[tuple]:
+    """
+    Reúne las imágenes del lote desde los archivos subidos y/o un zip
+    
+    Returns:
+        List[tuple]: (nombre, bytes) de cada imagen
+    Raises:
+        HTTPException: Si el lote está vacío, el zip no es válido o se superan los límites
+    """
+    archivos = []
+    total_bytes = 0
+    for archivo in files or []:
+        contenido = await leer_subida(archivo, "lote")
+        total_bytes += len(contenido)
+        archivos.append((archivo.filename or f"imagen_{len(archivos)}", contenido))
+    
+    if archive is not None:
+        try:
+            with zipfile.ZipFile(abrir_buffer(await leer_subida(archive, "lote"))) as zf:
+                for info in zf.infolist():
+                    nombre = info.filename
+                    if info.is_dir() or nombre.startswith("__MACOSX/") or not nombre.lower().endswith(EXTENSIONES_LOTE):
+                        continue
+                    # Se valida el tamaño declarado antes de descomprimir
+                    total_bytes += info.file_size
+                    if total_bytes > IMAGE_BATCH_MAX_BYTES:
+                        break
+                    archivos.append((nombre, zf.read(info)))
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="El archivo zip no es válido")
+    
+    if not archivos:
+        raise HTTPException(status_code=400, detail="No se recibieron imágenes")
+    if len(archivos) > IMAGE_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"El lote admite como máximo {IMAGE_BATCH_MAX_FILES} imágenes")
+    if total_bytes > IMAGE_BATCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"El lote supera {IMAGE_BATCH_MAX_BYTES} bytes")
+    vacios = [nombre for nombre, contenido in archivos if not contenido]
+    if vacios:
+        raise HTTPException(status_code=400, detail=f"Archivos vacíos: {vacios}")
+    return archivos
+
+async def generar_ndjson_lote(archivos: List[tuple], steps: int, opciones: OpcionesBarrido):
+    """
+    Serializa los resultados de un lote como líneas NDJSON, identificando cada imagen
+    
+    El resumen final cuenta por separado las imágenes completadas y las
+    fallidas; su estado es 'success' si no falló ninguna, 'partial' si
+    fallaron algunas y 'error' si fallaron todas.
+    """
+    completadas = fallidas = 0
+    try:
+        async for resultado in image_processor.stream_batch(archivos, steps, opciones):
+            if "k" in resultado:
+                linea = {"index": resultado["index"], "file": resultado["file"], **serializar_resultado(resultado, opciones.formato)}
+            else:
+                linea = resultado
+                if resultado["status"] == "success":
+                    completadas += 1
+                else:
+                    fallidas += 1
+            yield json.dumps(linea) + "\n"
+        if not fallidas:
+            estado = "success"
+        elif completadas:
+            estado = "partial"
+        else:
+            estado = "error"
+        yield json.dumps({"status": estado, "succeeded": completadas, "failed": fallidas}) + "\n"
+    except Exception as e:
+        logger.error(f"Error procesando lote en streaming: {e}")
+        yield json.dumps({"status": "error", "detail": str(e)}) + "\n"
+
+@app.post("/process-images/")
+async def process_images(
+    files: List[UploadFile] = File(None),
+    archive: UploadFile = File(None),
+    steps: int = Query(..., description="Número de clusters para K-means", ge=2, le=100),
+    opciones: OpcionesBarrido = Depends(opciones_barrido)
+):
+    """
+    Endpoint para procesar un lote de imágenes con K-means
+    
+    Las imágenes se envían como varios campos `files` y/o como un zip en
+    `archive`. Todo el lote ocupa un único turno de procesamiento y sus
+    unidades (imagen, k) se reparten en el pool compartido. La respuesta es
+    NDJSON: una línea por resultado con `index` y `file` de la imagen, una
+    línea de estado al terminar cada imagen y un resumen final con el número
+    de imágenes completadas (`succeeded`) y fallidas (`failed`).
+    
+    Returns:
+        StreamingResponse: Resultados en NDJSON a medida que terminan
+    """
+    archivos = await leer_archivos_lote(files, archive)
+    image_processor.verificar_capacidad()
+    return StreamingResponse(generar_ndjson_lote(archivos, steps, opciones), media_type="application/x-ndjson")
+
 @app.post("/classifier/get-parameters/")
 async def get_classifier_parameters(file: UploadFile = File(...)):
     """Endpoint para obtener los parámetros a analizar del archivo"""
     try:
-        contents = await file.read()
-        df = cargar_datos_desde_excel(contents)
-        
-        if df is None:
-            raise HTTPException(status_code=400, detail="Error al cargar el archivo")
-            
-        parametros = df.columns[:-1].tolist()
+        contents = await leer_subida(file, "clasificador")
+        parametros = leer_encabezado(contents)[:-1]
         
         return {
             "message": "Parámetros obtenidos correctamente",
             "parameters": parametros
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/classifier/analyze/")
 async def analyze_classifier(
     file: UploadFile = File(...),
-    answers: str = Form(...)
+    answers: str = Form(...),
+    training_mode: str = Form("auto")
 ):
-    """Endpoint para analizar las respuestas y obtener predicciones"""
+    """
+    Endpoint para analizar las respuestas y obtener predicciones
+
+    `training_mode` elige entre entrenar en memoria ('memory'), por bloques
+    ('streaming') o según el tamaño del archivo ('auto').
+    """
     try:
-        contents = await file.read()
+        contents = await leer_subida(file, "clasificador")
         respuestas = json.loads(answers)
         
-        df = cargar_datos_desde_excel(contents)
-        if df is None:
-            raise HTTPException(status_code=400, detail="Error al cargar el archivo")
+        # Entrenar modelos o reutilizarlos si el archivo ya fue procesado
+        modelos, accuracies, scaler = await asyncio.to_thread(obtener_modelos_clasificador, contents, training_mode)
 
-        # Entrenar modelos
-        modelos, accuracies, scaler = entrenar_modelo_knn(df)
-        if modelos is None:
-            raise HTTPException(status_code=500, detail="Error al entrenar los modelos")
-
-        # Procesar respuestas
-        respuestas_norm = scaler.transform([respuestas])
-        
-        predicciones = {}
-        for nombre, modelo in modelos.items():
-            pred_valor = int(modelo.predict(respuestas_norm)[0])
-            predicciones[nombre] = {
-                "mensaje": "Posible caso de diabetes" if pred_valor == 1 else "No se detecta diabetes",
-                "valor": pred_valor,
-                "accuracy": accuracies[nombre]
-            }
-        
-        votos_positivos = sum(1 for pred in predicciones.values() if pred["valor"] == 1)
-        prediccion_final = "Posible caso de diabetes" if votos_positivos > len(predicciones)/2 else "No se detecta diabetes"
-        
-        return {
-            "decision": prediccion_final,
-            "predicciones_por_modelo": predicciones
-        }
+        return formatear_prediccion(respuestas, modelos, accuracies, scaler)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/classifier/analyze-batch/")
+async def analyze_classifier_batch(
+    file: UploadFile = File(...),
+    answers: str = Form(None),
+    answers_file: UploadFile = File(None),
+    training_mode: str = Form("auto")
+):
+    """
+    Endpoint para analizar un lote de casos en una sola petición
+
+    Las respuestas se envían como matriz JSON en `answers` o como un CSV en
+    `answers_file` con las mismas columnas que el archivo de entrenamiento.
+    """
+    try:
+        if answers is None and answers_file is None:
+            raise HTTPException(status_code=400, detail="Debe enviar answers o answers_file")
+
+        contents = await leer_subida(file, "clasificador")
+        modelos, accuracies, scaler = await asyncio.to_thread(obtener_modelos_clasificador, contents, training_mode)
+
+        if answers_file is not None:
+            respuestas = cargar_respuestas_lote(await leer_subida(answers_file, "clasificador"), scaler)
+        else:
+            respuestas = json.loads(answers)
+
+        if len(respuestas) == 0:
+            raise HTTPException(status_code=400, detail="No se recibieron respuestas")
+
+        return formatear_prediccion_lote(respuestas, modelos, accuracies, scaler)
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Rutas de trabajos de imágenes en segundo plano
+@app.post("/image-jobs/", status_code=202)
+async def create_image_job(
+    session_id: str = Query(..., description="ID de la sesión creada con /upload-image/"),
+    steps: int = Query(..., description="Número de clusters para K-means", ge=2, le=100),
+    opciones: OpcionesBarrido = Depends(opciones_barrido)
+):
+    """
+    Inicia el procesamiento en segundo plano de la imagen de una sesión
+    
+    Returns:
+        dict: ID del trabajo para consultar su progreso y resultados
+    """
+    session = await get_session(session_id, 'image')
+    image_processor.verificar_capacidad()
+    
+    trabajo = TrabajoImagen(session.id, steps, opciones)
+    if not await asyncio.to_thread(almacen_trabajos.crear, trabajo):
+        raise HTTPException(status_code=409, detail="La sesión ya tiene un trabajo en curso")
+    image_jobs[trabajo.id] = trabajo
+    trabajo.tarea = asyncio.create_task(ejecutar_trabajo(trabajo, session.contenido()))
+    
+    logger.info(f"Trabajo {trabajo.id} creado para la sesión {session_id}")
+    return {
+        "job_id": trabajo.id,
+        "session_id": session_id,
+        "status": trabajo.estado
+    }
+
+CAMPOS_RESUMEN_TRABAJO = ("job_id", "session_id", "status", "completados", "total", "progreso", "error")
+
+async def obtener_trabajo(job_id: str) -> dict:
+    """
+    Obtiene el estado de un trabajo de cualquier worker
+    
+    Raises:
+        HTTPException: Si el trabajo no existe
+    """
+    trabajo = await asyncio.to_thread(almacen_trabajos.obtener, job_id)
+    if not trabajo:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return trabajo
+
+def resumen_trabajo(trabajo: dict) -> dict:
+    """Estado y progreso del trabajo"""
+    return {campo: trabajo[campo] for campo in CAMPOS_RESUMEN_TRABAJO}
+
+@app.get("/image-jobs/{job_id}")
+async def get_image_job(job_id: str):
+    """Endpoint para consultar el estado y progreso de un trabajo"""
+    return resumen_trabajo(await obtener_trabajo(job_id))
+
+@app.get("/image-jobs/{job_id}/results")
+async def get_image_job_results(
+    job_id: str,
+    desde: int = Query(0, description="Índice del primer resultado a devolver", ge=0),
+    delivery: str = Query("data_uri", description="data_uri devuelve las imágenes en base64, url devuelve la ruta de cada imagen")
+):
+    """
+    Endpoint para obtener los resultados disponibles de un trabajo
+    
+    Permite consultas incrementales: `siguiente` indica el valor de `desde`
+    para la próxima petición. Con `delivery=url` cada imagen se descarga en
+    binario desde /image-jobs/{job_id}/frames/{k}.
+    """
+    if delivery not in ("data_uri", "url"):
+        raise HTTPException(status_code=400, detail=f"Modo de entrega no soportado: {delivery}")
+    trabajo = await obtener_trabajo(job_id)
+    if not trabajo["sesion"]:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    
+    resultados = await asyncio.to_thread(almacen_trabajos.resultados, job_id, desde, delivery == "data_uri")
+    formato = trabajo["formato"]
+    if delivery == "url":
+        imagenes = [
+            {"k": resultado["k"], "url": f"/image-jobs/{job_id}/frames/{resultado['k']}"}
+            for resultado in resultados
+        ]
+    else:
+        imagenes = [serializar_resultado(resultado, formato) for resultado in resultados]
+    return {
+        **resumen_trabajo(trabajo),
+        "images": imagenes,
+        "siguiente": desde + len(resultados)
+    }
+
+@app.get("/image-jobs/{job_id}/frames/{k}")
+async def get_image_job_frame(
+    job_id: str,
+    k: int,
+    image_format: str = Query(None, description="Recodifica la imagen en jpeg, webp o png (por defecto el formato del trabajo)"),
+    quality: int = Query(85, description="Calidad de compresión para jpeg y webp", ge=1, le=100)
+):
+    """
+    Endpoint para descargar en binario la imagen de un k de un trabajo
+    
+    Si se pide un formato distinto al del trabajo la imagen se reconstruye bajo
+    demanda, por ejemplo un JPEG a partir del PNG indexado.
+    """
+    trabajo = await obtener_trabajo(job_id)
+    if not trabajo["sesion"]:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    if image_format is not None and image_format not in FORMATOS_IMAGEN:
+        raise HTTPException(status_code=400, detail=f"Formato de imagen no soportado: {image_format}")
+    
+    resultado = await asyncio.to_thread(almacen_trabajos.resultado, job_id, k)
+    if resultado is None:
+        raise HTTPException(status_code=404, detail=f"La imagen para k={k} aún no está disponible")
+    imagen = resultado["image"]
+    formato = trabajo["formato"]
+    if image_format is not None and image_format != formato:
+        imagen = await asyncio.get_running_loop().run_in_executor(
+            None, convertir_formato, imagen, image_format, quality
+        )
+        formato = image_format
+    return Response(content=imagen, media_type=FORMATOS_IMAGEN[formato]["media_type"])